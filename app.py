@@ -9,7 +9,23 @@ except ImportError as e:
     print(f"Warning: pandas not available: {e}", file=sys.stderr)
     pd = None
 
-from flask import Flask, render_template, request, jsonify, flash, redirect, url_for, session, send_from_directory
+try:
+    import numpy as np
+except ImportError as e:
+    print(f"Warning: numpy not available: {e}", file=sys.stderr)
+    np = None
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError as e:
+    print(f"Warning: scipy not available: {e}", file=sys.stderr)
+    cKDTree = None
+
+import click
+from flask import Flask, render_template, request, jsonify, flash, redirect, url_for, session, send_from_directory, Response
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
 from werkzeug.utils import secure_filename
 
 try:
@@ -28,6 +44,11 @@ try:
 except ImportError:
     load_dotenv = None
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: migrations run unlocked
+
 try:
     from geopy.distance import geodesic
 except ImportError as e:
@@ -39,6 +60,19 @@ import requests
 from datetime import datetime, timedelta
 import uuid
 import re
+import hashlib
+import base64
+import threading
+import secrets
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+import csv
+import io
+import bisect
+import heapq
+from collections import Counter
+from itertools import combinations
 
 try:
     import pgeocode
@@ -95,9 +129,20 @@ def _load_db():
     except Exception:
         return []
 
+def _write_json_atomic(path, data):
+    """Write JSON to a temp file and rename it over path, so readers never see a partial write."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 def _save_db(records):
-    with open(DB_FILE, 'w') as f:
-        json.dump(records, f, indent=2)
+    _write_json_atomic(DB_FILE, records)
+    _invalidate_analysis_cache()
 
 def _load_markets_db():
     """Load markets/zip data from file-based database."""
@@ -111,8 +156,378 @@ def _load_markets_db():
 
 def _save_markets_db(records):
     """Save markets/zip data to file-based database."""
-    with open(MARKETS_DB_FILE, 'w') as f:
-        json.dump(records, f, indent=2)
+    _write_json_atomic(MARKETS_DB_FILE, records)
+    _invalidate_analysis_cache()
+
+# Server-side sessions: session data (markets_rows can be thousands of rows) lives in
+# SQLite and the cookie only carries a random session id.
+SESSION_DB_FILE = os.path.join(DATA_DIR, 'sessions.sqlite3')
+# Expired rows are also deleted every this many session saves, so a long-running
+# process does not depend on restarts to keep the table small
+SESSION_PURGE_EVERY_SAVES = 500
+
+class _ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+class SqliteSessionInterface(SessionInterface):
+    """Flask session interface storing each session's data in SESSION_DB_FILE."""
+
+    serializer = TaggedJSONSerializer()
+    saves = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(SESSION_DB_FILE, timeout=10)
+        conn.execute('CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)')
+        return conn
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            try:
+                with closing(self._connect()) as conn:
+                    row = conn.execute('SELECT data FROM sessions WHERE sid = ? AND expires > ?', (sid, time.time())).fetchone()
+                if row:
+                    return _ServerSession(self.serializer.loads(row[0]), sid=sid)
+            except Exception as e:
+                logger.error(f"Error loading session: {e}")
+        return _ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                with closing(self._connect()) as conn, conn:
+                    conn.execute('DELETE FROM sessions WHERE sid = ?', (session.sid,))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not self.should_set_cookie(app, session):
+            return
+
+        expires = self.get_expiration_time(app, session)
+        expires_at = expires.timestamp() if expires else time.time() + app.permanent_session_lifetime.total_seconds()
+        with closing(self._connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)',
+                         (session.sid, self.serializer.dumps(dict(session)), expires_at))
+            self.saves += 1
+            if self.saves % SESSION_PURGE_EVERY_SAVES == 0:
+                _delete_expired_sessions(conn)
+        response.set_cookie(name, session.sid, expires=expires, httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+def _delete_expired_sessions(conn):
+    return conn.execute('DELETE FROM sessions WHERE expires <= ?', (time.time(),)).rowcount
+
+def _purge_expired_sessions():
+    if not os.path.exists(SESSION_DB_FILE):
+        return 0
+    with closing(app.session_interface._connect()) as conn, conn:
+        return _delete_expired_sessions(conn)
+
+app.session_interface = SqliteSessionInterface()
+
+# Archive tier: removed retailers and superseded markets uploads live in
+# separate files that only restore and history views read.
+RETAILER_ARCHIVE_FILE = os.path.join(DATA_DIR, 'retailer_archive.json')
+MARKETS_ARCHIVE_FILE = os.path.join(DATA_DIR, 'markets_archive.json')
+
+def _load_retailer_archive():
+    """Load removed retailers from the archive file."""
+    if not os.path.exists(RETAILER_ARCHIVE_FILE):
+        return []
+    try:
+        with open(RETAILER_ARCHIVE_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return []
+
+def _save_retailer_archive(records):
+    _write_json_atomic(RETAILER_ARCHIVE_FILE, records)
+
+def _load_markets_archive():
+    """Load superseded markets uploads from the archive file."""
+    if not os.path.exists(MARKETS_ARCHIVE_FILE):
+        return []
+    try:
+        with open(MARKETS_ARCHIVE_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return []
+
+def _save_markets_archive(records):
+    _write_json_atomic(MARKETS_ARCHIVE_FILE, records)
+
+# Archived uploads are stored as deltas: each one keeps only the rows it has that the
+# next archived upload lacks (with their positions) and the positions of the next
+# upload's rows it lacks. The newest archived upload and the current upload are always
+# stored in full, so a failed write between the archive and the current file never
+# leaves a delta without its base.
+
+def _markets_row_key(row):
+    return (row.get('City', ''), row.get('State', ''), row.get('Zip Codes', ''))
+
+def _encode_markets_rows(rows, next_rows):
+    """
+    Rows as a delta against next_rows, matched by row key so reordered uploads still diff.
+
+    Returns:
+        dict: added [[position in rows, row]] for rows next_rows lacks, dropped [positions
+            in next_rows] for its rows these lack and, only when the shared rows were
+            reordered, order [positions in next_rows of the shared rows, in rows' order]
+    """
+    # Positions of each key in next_rows; repeated keys are matched first to first
+    available = {}
+    for position, row in enumerate(next_rows):
+        available.setdefault(_markets_row_key(row), []).append(position)
+    for positions in available.values():
+        positions.reverse()
+
+    added, kept = [], []
+    for position, row in enumerate(rows):
+        positions = available.get(_markets_row_key(row))
+        if positions:
+            kept.append(positions.pop())
+        else:
+            added.append([position, row])
+    kept_set = set(kept)
+    delta = {'added': added, 'dropped': [position for position in range(len(next_rows)) if position not in kept_set]}
+    if kept != sorted(kept):
+        delta['order'] = kept
+    return delta
+
+def _decode_markets_rows(next_rows, delta):
+    if 'order' in delta:
+        rows = [next_rows[position] for position in delta['order']]
+    else:
+        dropped = set(delta['dropped'])
+        rows = [row for position, row in enumerate(next_rows) if position not in dropped]
+    for position, row in delta['added']:
+        rows.insert(position, row)
+    return rows
+
+def _markets_row_label(row):
+    return f"{row.get('City', '')}, {row.get('State', '')}"
+
+def _markets_upload_delta(previous_upload, rows):
+    """What an upload changes relative to the previous current upload, by "City, ST"."""
+    previous = {_markets_row_label(row) for row in (previous_upload or {}).get('data', [])}
+    current = {_markets_row_label(row) for row in rows}
+    return {
+        'base_uploaded': (previous_upload or {}).get('date_uploaded'),
+        'added': sorted(current - previous),
+        'removed': sorted(previous - current),
+        'unchanged': len(current & previous),
+    }
+
+def _load_markets_archive_expanded():
+    """Archived uploads, oldest first, each with its full 'data' rows."""
+    archive = _load_markets_archive()
+    for i in range(len(archive) - 2, -1, -1):
+        if 'data' not in archive[i]:
+            entry = {key: value for key, value in archive[i].items() if key != 'data_delta'}
+            entry['data'] = _decode_markets_rows(archive[i + 1]['data'], archive[i]['data_delta'])
+            archive[i] = entry
+    return archive
+
+def _save_markets_archive_compact(archive):
+    """Store archived uploads, all but the newest as deltas against the next one."""
+    stored = []
+    for i, entry in enumerate(archive):
+        if i + 1 < len(archive):
+            delta = _encode_markets_rows(entry['data'], archive[i + 1]['data'])
+            entry = {key: value for key, value in entry.items() if key != 'data'}
+            entry['data_delta'] = delta
+        stored.append(entry)
+    _save_markets_archive(stored)
+
+def _add_markets_upload(markets_entry):
+    """Make markets_entry the current upload and move previous uploads to the archive."""
+    superseded = _load_markets_db()
+    if superseded:
+        # Archive first: a failure between the two writes duplicates history rather than losing it
+        _save_markets_archive_compact(_load_markets_archive_expanded() + superseded)
+    _save_markets_db([markets_entry])
+
+def _load_markets_history():
+    """All markets uploads, oldest first; the last one is the current upload."""
+    return _load_markets_archive_expanded() + _load_markets_db()
+
+def _archive_superseded_markets():
+    """Move all but the most recent markets upload into the archive (one-time cleanup of older data)."""
+    markets_db = _load_markets_db()
+    if len(markets_db) <= 1:
+        return 0
+    _save_markets_archive_compact(_load_markets_archive_expanded() + markets_db[:-1])
+    _save_markets_db(markets_db[-1:])
+    logger.info(f"Archived {len(markets_db) - 1} superseded markets uploads")
+    return len(markets_db) - 1
+
+# Schema version of the retailer database lives in a sidecar file so the
+# database itself stays a plain list of retailer entries.
+DB_META_FILE = os.path.join(DATA_DIR, 'retailer_database_meta.json')
+
+def _load_db_meta():
+    """Load retailer database metadata (schema version, last migration time)."""
+    if not os.path.exists(DB_META_FILE):
+        return {}
+    try:
+        with open(DB_META_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def _save_db_meta(meta):
+    """Save retailer database metadata."""
+    _write_json_atomic(DB_META_FILE, meta)
+
+def _migrate_v1_active_stores(retailer_data):
+    """Filter permanently closed stores and add total_cities to older retailer entries."""
+    for retailer in retailer_data:
+        # Entries saved by current code already have these fields
+        if 'total_cities' in retailer:
+            continue
+
+        active_stores = []
+        for store in retailer.get('stores', []):
+            business_status = store.get('business_status', '').lower()
+            if business_status not in ['permanently_closed', 'closed_permanently']:
+                active_stores.append(store)
+
+        unique_cities = set()
+        for store in active_stores:
+            city = store.get('city', '').strip()
+            if city:
+                unique_cities.add(city)
+
+        retailer['stores'] = active_stores
+        retailer['total_stores'] = len(active_stores)
+        retailer['total_cities'] = len(unique_cities)
+
+        logger.info(f"Migrated retailer '{retailer.get('retailer_name', 'Unknown')}': {len(active_stores)} active stores across {len(unique_cities)} cities")
+
+    return retailer_data
+
+# Retailer-entry bookkeeping keys that must not leak into a legacy store record
+_RETAILER_ENTRY_FIELDS = {'stores', 'total_stores', 'total_cities', 'date_added', 'removed', 'removed_date'}
+
+def _migrate_v2_normalize_stores(retailer_data):
+    """Normalize every store (see _normalize_store) and fold legacy flat store records into retailer entries."""
+    migrated = []
+    for retailer in retailer_data:
+        legacy_store = retailer.get('google_store') or retailer
+        if not retailer.get('stores') and (legacy_store.get('formatted_address') or legacy_store.get('address')):
+            # Old structure: the record itself is a single store
+            store = _normalize_store({k: v for k, v in legacy_store.items() if k not in _RETAILER_ENTRY_FIELDS})
+            migrated.append({
+                'retailer_name': store['name'] or 'Unknown',
+                'stores': [store],
+                'total_stores': 1,
+                'total_cities': _count_cities([store]),
+                'date_added': retailer.get('date_added') or datetime.now().isoformat(),
+                'source': 'legacy',
+                'removed': retailer.get('removed', False)
+            })
+            continue
+
+        retailer['stores'] = [_normalize_store(store) for store in retailer.get('stores', [])]
+        retailer['total_stores'] = len(retailer['stores'])
+        retailer['total_cities'] = _count_cities(retailer['stores'])
+        migrated.append(retailer)
+
+    logger.info(f"Normalized stores for {len(migrated)} retailer entries")
+    return migrated
+
+def _migrate_v3_content_hashes(retailer_data):
+    """Record a content_hash on every retailer entry so repeated saves can be detected."""
+    for retailer in retailer_data:
+        retailer['content_hash'] = _stores_content_hash(retailer.get('retailer_name', ''), retailer.get('stores', []))
+    return retailer_data
+
+def _migrate_v4_archive_removed(retailer_data):
+    """Give every retailer a stable retailer_id and move removed retailers to the archive file."""
+    for retailer in retailer_data:
+        retailer.setdefault('retailer_id', uuid.uuid4().hex)
+
+    removed = [r for r in retailer_data if r.get('removed', False)]
+    if removed:
+        _save_retailer_archive(_load_retailer_archive() + removed)
+        logger.info(f"Archived {len(removed)} removed retailers")
+    return [r for r in retailer_data if not r.get('removed', False)]
+
+# Ordered (version, migration) pairs. Each migration takes the full list of
+# retailer entries and returns the updated list; it runs exactly once, when the
+# stored schema version is below its version number. Append new migrations here.
+RETAILER_DB_MIGRATIONS = [
+    (1, _migrate_v1_active_stores),
+    (2, _migrate_v2_normalize_stores),
+    (3, _migrate_v3_content_hashes),
+    (4, _migrate_v4_archive_removed),
+]
+DB_SCHEMA_VERSION = RETAILER_DB_MIGRATIONS[-1][0]
+
+DB_MIGRATION_LOCK_FILE = os.path.join(DATA_DIR, 'retailer_database.lock')
+
+@contextmanager
+def _file_lock(lock_path):
+    """Hold an exclusive lock on lock_path across processes and threads (no-op without fcntl)."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(lock_path) or '.', exist_ok=True)
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _run_migrations():
+    """Apply pending retailer database migrations and record the new schema version.
+
+    Called once per serving process by prepare_app (and available as `flask migrate-db`
+    for deploys), so request handlers can assume the database is already at DB_SCHEMA_VERSION.
+
+    Returns:
+        int: Schema version of the database after migrating
+    """
+    # Workers starting together migrate once
+    with _file_lock(DB_MIGRATION_LOCK_FILE):
+        return _run_pending_migrations()
+
+def _run_pending_migrations():
+    # Read under the lock: another worker may have just finished migrating
+    meta = _load_db_meta()
+    current_version = meta.get('schema_version', 0)
+    pending = [(version, migration) for version, migration in RETAILER_DB_MIGRATIONS if version > current_version]
+    if not pending:
+        return current_version
+
+    # Nothing stored yet: new entries are written in the current shape, so the
+    # database starts at the current version.
+    if not os.path.exists(DB_FILE):
+        meta['schema_version'] = DB_SCHEMA_VERSION
+        _save_db_meta(meta)
+        return DB_SCHEMA_VERSION
+
+    retailer_data = _load_db()
+    for version, migration in pending:
+        logger.info(f"Running retailer database migration {version}: {migration.__name__}")
+        retailer_data = migration(retailer_data)
+
+    _save_db(retailer_data)
+    meta['schema_version'] = pending[-1][0]
+    meta['migrated_at'] = datetime.now().isoformat()
+    _save_db_meta(meta)
+    logger.info(f"Retailer database migrated from schema version {current_version} to {meta['schema_version']}")
+    return meta['schema_version']
 
 # In-memory cache for large search results (session stores only a token)
 LAST_RESULTS_CACHE = {}
@@ -552,51 +967,13 @@ def index():
     """Main page with search form and file upload."""
     return render_template('index.html')
 
-def _migrate_retailer_data():
-    """Migrate existing retailer data to include total_cities and filter closed stores."""
-    retailer_data = _load_db()
-    updated = False
-    
-    for retailer in retailer_data:
-        # Skip if already migrated
-        if 'total_cities' in retailer:
-            continue
-            
-        # Filter out permanently closed stores
-        active_stores = []
-        for store in retailer.get('stores', []):
-            business_status = store.get('business_status', '').lower()
-            if business_status not in ['permanently_closed', 'closed_permanently']:
-                active_stores.append(store)
-        
-        # Count unique cities from active stores
-        unique_cities = set()
-        for store in active_stores:
-            city = store.get('city', '').strip()
-            if city:
-                unique_cities.add(city)
-        
-        # Update retailer data
-        retailer['stores'] = active_stores
-        retailer['total_stores'] = len(active_stores)
-        retailer['total_cities'] = len(unique_cities)
-        updated = True
-        
-        logger.info(f"Migrated retailer '{retailer.get('retailer_name', 'Unknown')}': {len(active_stores)} active stores across {len(unique_cities)} cities")
-    
-    if updated:
-        _save_db(retailer_data)
-        logger.info("Retailer database migration completed")
-    
-    return retailer_data
-
 @app.route('/retailer-database')
 def retailer_database():
     """Retailer Database page showing saved retailer data."""
-    # Migrate existing data if needed
-    all_retailer_data = _migrate_retailer_data()
-    # Filter out removed retailers for display, but keep them in the data for restore functionality
-    active_retailers = [r for r in all_retailer_data if not r.get('removed', False)]
+    # Schema migrations run once at startup (see _run_migrations), not per request
+    active_retailers = _load_db()
+    # Removed retailers come from the archive so they can be restored from this page
+    all_retailer_data = active_retailers + _load_retailer_archive()
     logger.info(f"Retailer database page loaded with {len(active_retailers)} active retailers out of {len(all_retailer_data)} total")
     return render_template('retailer_database.html', retailer_data=all_retailer_data, api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
 
@@ -606,6 +983,509 @@ def usage():
     billing_url = "https://console.cloud.google.com/billing/017DF5-773A3D-847C0E?organizationId=61770565445"
     return render_template('usage.html', billing_url=billing_url)
 
+# US postal table, loaded once with the lookup columns precomputed, so geo lookups never
+# re-scan or re-casefold the ~40k-row frame per request. The bundled POSTAL_TABLE_FILE is
+# a compact numpy structured array (zip, place, state, county, lat, lng), memory-mapped
+# read-only so its pages come from the shared page cache, and offline hosts need no
+# download; pgeocode (GeoNames) is the fallback when it is missing. prepare_app loads the
+# table and every lookup built from it before gunicorn forks (--preload in the Procfile),
+# so workers inherit one copy instead of each decoding their own. The bundled copy is
+# built from the USPS-derived `zipcodes` package rather than GeoNames: place names follow
+# USPS spelling and PO box / unique ZIPs are included. Both feed the same resolver.
+POSTAL_DATA_LOCK = threading.Lock()
+POSTAL_TABLE_FILE = os.path.join(DATA_DIR, 'us_postal.npy')
+
+# APO/FPO "states" (Armed Forces Americas/Europe/Pacific) have no real location
+_MILITARY_STATE_CODES = ('AA', 'AE', 'AP')
+
+def _clean_postal_frame(geo_df):
+    """Drop rows without a place or outside the US states, and blank (0, 0) coordinates."""
+    geo_df = geo_df.dropna(subset=['place_name', 'state_code', 'postal_code'])
+    geo_df = geo_df[~geo_df['state_code'].astype(str).str.upper().isin(_MILITARY_STATE_CODES)].copy()
+    unplaced = (geo_df['latitude'] == 0) & (geo_df['longitude'] == 0)
+    geo_df.loc[unplaced, ['latitude', 'longitude']] = np.nan
+    return geo_df.reset_index(drop=True)
+
+def _zipcodes_postal_frame():
+    """The `zipcodes` package's table as a pgeocode-style frame (source of the bundled file)."""
+    import zipcodes
+    rows = zipcodes.list_all()
+    return pd.DataFrame({
+        'postal_code': [row['zip_code'] for row in rows],
+        'place_name': [row['city'] for row in rows],
+        'state_code': [row['state'] for row in rows],
+        'county_name': [row.get('county') or '' for row in rows],
+        'latitude': pd.to_numeric([row.get('lat') for row in rows], errors='coerce'),
+        'longitude': pd.to_numeric([row.get('long') for row in rows], errors='coerce'),
+    })
+
+def _build_postal_table(geo_df):
+    """Pack a pgeocode-style frame into the compact structured array stored in POSTAL_TABLE_FILE."""
+    geo_df = _clean_postal_frame(geo_df)
+    columns = {
+        'zip': geo_df['postal_code'].astype(str).str.zfill(5),
+        'place': geo_df['place_name'].astype(str),
+        'state': geo_df['state_code'].astype(str).str.upper(),
+        'county': geo_df['county_name'].fillna('').astype(str),
+    }
+    encoded = {name: values.str.encode('utf-8') for name, values in columns.items()}
+    dtype = [(name, f'S{max(1, int(values.str.len().max()))}') for name, values in encoded.items()]
+    dtype += [('lat', '<f4'), ('lng', '<f4')]
+    table = np.empty(len(geo_df), dtype=dtype)
+    for name, values in encoded.items():
+        table[name] = values.to_numpy()
+    table['lat'] = geo_df['latitude'].to_numpy(dtype=float)
+    table['lng'] = geo_df['longitude'].to_numpy(dtype=float)
+    return table
+
+def _read_postal_table():
+    """The bundled postal table as a pgeocode-style frame, or None when the file is missing."""
+    if np is None or not os.path.exists(POSTAL_TABLE_FILE):
+        return None
+    table = np.load(POSTAL_TABLE_FILE, mmap_mode='r')
+
+    def decode(name):
+        return [value.decode('utf-8') for value in table[name].tolist()]
+
+    return pd.DataFrame({
+        'postal_code': decode('zip'),
+        'place_name': decode('place'),
+        'state_code': decode('state'),
+        'county_name': decode('county'),
+        # Stored as float32; the source data has 4-5 decimal places
+        'latitude': table['lat'].astype(float).round(5),
+        'longitude': table['lng'].astype(float).round(5),
+    })
+
+def _load_postal_data():
+    """
+    Load the US postal table and precompute its lookup columns and group indexes.
+
+    Returns:
+        dict: frame (DataFrame with city_key, state_upper and zip columns added) and
+            by_city_state {(city_key, state): row positions}; None when unavailable
+    """
+    if pd is None:
+        return None
+    geo_df = _read_postal_table()
+    if geo_df is None:
+        if pgeocode is None:
+            return None
+        try:
+            geo_df = pgeocode.Nominatim('us')._data
+        except Exception as e:
+            logger.warning(f"pgeocode data unavailable: {e}")
+            return None
+    geo_df = _clean_postal_frame(geo_df)
+    geo_df['city_key'] = geo_df['place_name'].map(_normalize_city_name)
+    geo_df['state_upper'] = geo_df['state_code'].astype(str).str.upper()
+    geo_df['zip'] = geo_df['postal_code'].astype(str).str.zfill(5)
+
+    by_city_state = geo_df.groupby(['city_key', 'state_upper']).indices
+    logger.info(f"Loaded postal data: {len(geo_df)} rows, {len(by_city_state)} cities")
+    return {'frame': geo_df, 'by_city_state': by_city_state}
+
+def _get_postal_data():
+    with POSTAL_DATA_LOCK:
+        postal = _get_cached_index('postal_data', 'us', _load_postal_data)
+        if postal is None:
+            # Retry on the next call instead of disabling postal lookups until restart
+            DATA_INDEX_CACHE.pop('postal_data', None)
+        return postal
+
+def warm_postal_data():
+    """
+    Load the postal table and the indexes built from it into this process.
+
+    Runs synchronously from prepare_app: under gunicorn --preload that is the master, and
+    a loader thread still running (or holding POSTAL_DATA_LOCK) at fork would leave
+    workers with a half-built cache and a lock nobody releases.
+    """
+    if _get_postal_data() is None:
+        return
+    _get_city_zip_index()
+    _get_city_state_table()
+    _get_city_trigram_index()
+    _get_city_prefix_index()
+    _get_centroid_tables()
+
+# Offline city -> ZIP resolver for market uploads, derived from the US postal table and
+# persisted so uploads never wait on the network: {state: {normalized city: [zips]}}.
+CITY_ZIP_INDEX_FILE = os.path.join(DATA_DIR, 'city_zip_index.json')
+ZIPPOPOTAM_ENRICHMENT = os.getenv('ZIPPOPOTAM_ENRICHMENT', '').lower() in ('1', 'true', 'yes')
+MARKETS_CSV_CHUNK_ROWS = 10000
+
+# Abbreviated words expanded so "St. Louis", "Saint Louis" and "st louis" share a key
+_CITY_WORD_ALIASES = {'st': 'saint', 'ste': 'sainte', 'ft': 'fort', 'mt': 'mount', 'pt': 'point'}
+
+def _normalize_city_name(name) -> str:
+    words = re.sub(r"[.'’]", '', str(name).casefold()).replace('-', ' ').split()
+    return ' '.join(_CITY_WORD_ALIASES.get(word, word) for word in words)
+
+def _build_city_zip_index():
+    """
+    Group the US postal codes by state and normalized place name.
+
+    Counties are added as "<name> county" aliases (e.g. "Essex County, MA") unless a
+    place already has that name.
+    """
+    postal = _get_postal_data()
+    if postal is None:
+        return {}
+    geo_df = postal['frame']
+    zip_values = geo_df['zip'].to_numpy()
+    index = {}
+    for (city, state), positions in postal['by_city_state'].items():
+        index.setdefault(state, {})[city] = set(zip_values[positions])
+
+    counties = geo_df['county_name'].fillna('').map(_normalize_city_name)
+    county_keys = counties.where(counties.str.endswith(' county') | (counties == ''), counties + ' county')
+    for (county, state), positions in geo_df.groupby([county_keys, geo_df['state_upper']]).indices.items():
+        if county:
+            index[state].setdefault(county, set(zip_values[positions]))
+    return {state: {city: sorted(zips) for city, zips in cities.items()} for state, cities in index.items()}
+
+def _load_city_zip_index():
+    """Read the persisted city -> ZIP index, building and saving it from the postal table on first use."""
+    if not os.path.exists(CITY_ZIP_INDEX_FILE):
+        try:
+            index = _build_city_zip_index()
+        except Exception as e:
+            logger.warning(f"Could not build city ZIP index: {e}")
+            index = {}
+        if index:
+            _write_json_atomic(CITY_ZIP_INDEX_FILE, index)
+            logger.info(f"Saved city ZIP index for {sum(len(c) for c in index.values())} cities")
+        states = index
+    else:
+        with open(CITY_ZIP_INDEX_FILE, 'r', encoding='utf-8') as f:
+            states = json.load(f)
+    # City-only lookups: {normalized city: [states, most ZIP codes first]}
+    cities = {}
+    for state, city_zips in states.items():
+        for city, zips in city_zips.items():
+            cities.setdefault(city, []).append((len(zips), state))
+    cities = {city: [state for _, state in sorted(counts, key=lambda c: (-c[0], c[1]))] for city, counts in cities.items()}
+    return {'states': states, 'cities': cities}
+
+def _get_city_zip_index():
+    index = _get_cached_index('city_zip', _file_version(CITY_ZIP_INDEX_FILE), _load_city_zip_index)
+    if not index['states']:
+        # Postal data was unavailable; build again once it loads
+        DATA_INDEX_CACHE.pop('city_zip', None)
+    return index
+
+def _resolve_city_zips(city, state):
+    """ZIPs for a city in a state from the offline index ("New York City" also tries "New York")."""
+    cities = _get_city_zip_index()['states'].get(state.upper(), {})
+    name = _normalize_city_name(city)
+    zips = cities.get(name)
+    if zips is None and name.endswith(' city'):
+        zips = cities.get(name[:-len(' city')])
+    return list(zips or [])
+
+# State assignment for market entries without one ("Springfield"): {normalized city:
+# [states, best first]}, persisted in CITY_STATE_TABLE_FILE together with the version
+# of the city index it was ranked from. States are ranked by ZIP count, except that
+# the major city of an ambiguous name is always first.
+CITY_STATE_TABLE_FILE = os.path.join(DATA_DIR, 'city_state_table.json')
+
+# Where a name is shared across states, the entry is the state of the most populous city
+# of that name (2020 census): Aurora CO over IL, Columbus OH over GA, Rochester NY over MN,
+# Springfield MO over MA and IL, Kansas City MO over KS, Charleston SC over WV, Fayetteville
+# NC over AR, Wilmington NC over DE, Concord CA over NC and NH, Bellevue WA over NE,
+# Burlington NC over VT. Towns and townships (Canton MI, Huntington NY) are not cities here.
+_MAJOR_CITY_STATES = {
+    'houston': 'TX', 'dallas': 'TX', 'san antonio': 'TX', 'austin': 'TX', 'fort worth': 'TX',
+    'phoenix': 'AZ', 'tucson': 'AZ', 'mesa': 'AZ', 'chandler': 'AZ',
+    'los angeles': 'CA', 'san diego': 'CA', 'san jose': 'CA', 'san francisco': 'CA',
+    'fresno': 'CA', 'sacramento': 'CA', 'long beach': 'CA', 'oakland': 'CA', 'concord': 'CA',
+    'chicago': 'IL', 'rockford': 'IL', 'joliet': 'IL',
+    'philadelphia': 'PA', 'pittsburgh': 'PA', 'allentown': 'PA', 'erie': 'PA',
+    'new york': 'NY', 'buffalo': 'NY', 'rochester': 'NY', 'yonkers': 'NY',
+    'miami': 'FL', 'tampa': 'FL', 'orlando': 'FL', 'saint petersburg': 'FL',
+    'atlanta': 'GA', 'augusta': 'GA', 'savannah': 'GA',
+    'nashville': 'TN', 'memphis': 'TN', 'knoxville': 'TN', 'chattanooga': 'TN',
+    'denver': 'CO', 'colorado springs': 'CO', 'aurora': 'CO', 'fort collins': 'CO',
+    'seattle': 'WA', 'spokane': 'WA', 'tacoma': 'WA', 'vancouver': 'WA', 'bellevue': 'WA',
+    'portland': 'OR', 'salem': 'OR', 'eugene': 'OR', 'gresham': 'OR',
+    'las vegas': 'NV', 'henderson': 'NV', 'reno': 'NV', 'north las vegas': 'NV',
+    'boston': 'MA', 'worcester': 'MA', 'cambridge': 'MA',
+    'detroit': 'MI', 'grand rapids': 'MI', 'warren': 'MI', 'sterling heights': 'MI',
+    'minneapolis': 'MN', 'saint paul': 'MN', 'duluth': 'MN',
+    'kansas city': 'MO', 'saint louis': 'MO', 'springfield': 'MO', 'independence': 'MO',
+    'cleveland': 'OH', 'cincinnati': 'OH', 'toledo': 'OH', 'akron': 'OH',
+    'columbus': 'OH', 'dayton': 'OH', 'parma': 'OH', 'canton': 'OH',
+    'indianapolis': 'IN', 'fort wayne': 'IN', 'evansville': 'IN', 'south bend': 'IN',
+    'milwaukee': 'WI', 'madison': 'WI', 'green bay': 'WI', 'kenosha': 'WI',
+    'baltimore': 'MD', 'frederick': 'MD', 'rockville': 'MD', 'gaithersburg': 'MD',
+    'charlotte': 'NC', 'raleigh': 'NC', 'greensboro': 'NC', 'durham': 'NC',
+    'fayetteville': 'NC', 'wilmington': 'NC', 'burlington': 'NC',
+    'virginia beach': 'VA', 'norfolk': 'VA', 'chesapeake': 'VA', 'richmond': 'VA',
+    'salt lake city': 'UT', 'west valley city': 'UT', 'provo': 'UT', 'west jordan': 'UT',
+    'oklahoma city': 'OK', 'tulsa': 'OK', 'norman': 'OK', 'broken arrow': 'OK',
+    'louisville': 'KY', 'lexington': 'KY', 'bowling green': 'KY', 'owensboro': 'KY',
+    'new orleans': 'LA', 'baton rouge': 'LA', 'shreveport': 'LA', 'lafayette': 'LA',
+    'albuquerque': 'NM', 'las cruces': 'NM', 'rio rancho': 'NM', 'santa fe': 'NM',
+    'omaha': 'NE', 'lincoln': 'NE', 'grand island': 'NE',
+    'wichita': 'KS', 'overland park': 'KS', 'topeka': 'KS',
+    'des moines': 'IA', 'cedar rapids': 'IA', 'davenport': 'IA', 'sioux city': 'IA',
+    'little rock': 'AR', 'fort smith': 'AR',
+    'jackson': 'MS', 'gulfport': 'MS', 'southaven': 'MS', 'hattiesburg': 'MS',
+    'birmingham': 'AL', 'montgomery': 'AL', 'mobile': 'AL', 'huntsville': 'AL',
+    'anchorage': 'AK', 'fairbanks': 'AK', 'juneau': 'AK',
+    'honolulu': 'HI', 'pearl city': 'HI', 'hilo': 'HI',
+    'boise': 'ID', 'nampa': 'ID', 'meridian': 'ID', 'idaho falls': 'ID',
+    'billings': 'MT', 'missoula': 'MT', 'great falls': 'MT', 'bozeman': 'MT',
+    'fargo': 'ND', 'bismarck': 'ND', 'grand forks': 'ND', 'minot': 'ND',
+    'sioux falls': 'SD', 'rapid city': 'SD', 'aberdeen': 'SD', 'brookings': 'SD',
+    'cheyenne': 'WY', 'casper': 'WY', 'laramie': 'WY', 'gillette': 'WY',
+    'south burlington': 'VT', 'colchester': 'VT', 'rutland': 'VT',
+    'manchester': 'NH', 'nashua': 'NH', 'derry': 'NH',
+    'providence': 'RI', 'warwick': 'RI', 'cranston': 'RI', 'pawtucket': 'RI',
+    'hartford': 'CT', 'bridgeport': 'CT', 'new haven': 'CT', 'stamford': 'CT',
+    'dover': 'DE',
+    'annapolis': 'MD', 'bowie': 'MD', 'hagerstown': 'MD',
+    'huntington': 'WV', 'parkersburg': 'WV', 'morgantown': 'WV',
+    'columbia': 'SC', 'charleston': 'SC', 'north charleston': 'SC', 'mount pleasant': 'SC',
+    'tallahassee': 'FL', 'fort lauderdale': 'FL', 'port saint lucie': 'FL', 'cape coral': 'FL',
+    'washington': 'DC'
+}
+
+def _build_city_state_table():
+    ranked = {city: list(states) for city, states in _get_city_zip_index()['cities'].items()}
+    for city, state in _MAJOR_CITY_STATES.items():
+        states = ranked.setdefault(_normalize_city_name(city), [])
+        if state in states:
+            states.remove(state)
+        states.insert(0, state)
+    return ranked
+
+def _load_city_state_table(index_version):
+    """
+    Read the persisted city -> state ranking, rebuilding and saving it when it was built
+    from another version of the city index (which is itself rebuilt on demand).
+    """
+    stored = None
+    if os.path.exists(CITY_STATE_TABLE_FILE):
+        try:
+            with open(CITY_STATE_TABLE_FILE, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError) as e:
+            # A truncated or corrupt table is rebuilt below rather than failing the upload
+            logger.warning(f"Rebuilding unreadable city state table: {e}")
+    if isinstance(stored, dict) and stored.get('city_index_version') == index_version:
+        return stored['cities']
+    table = _build_city_state_table()
+    if index_version is not None:
+        _write_json_atomic(CITY_STATE_TABLE_FILE, {'city_index_version': index_version, 'cities': table})
+        logger.info(f"Saved city state table for {len(table)} cities")
+    return table
+
+def _get_city_state_table():
+    # Building the city index may create its file, so take the version afterwards
+    _get_city_zip_index()
+    index_version = list(_file_version(CITY_ZIP_INDEX_FILE) or []) or None
+    return _get_cached_index('city_state', index_version, lambda: _load_city_state_table(index_version))
+
+def _rank_city_states(table, city):
+    """Candidate states for a city name, best first ("New York City" also tries "New York")."""
+    name = _normalize_city_name(city)
+    states = table.get(name)
+    if states is None and name.endswith(' city'):
+        states = table.get(name[:-len(' city')])
+    return states or []
+
+# Fuzzy fallback for market cities the exact index misses ("Pittsburg, PA", "Sant Petersburg"):
+# names are scored by the Dice overlap of their character trigrams.
+FUZZY_CITY_MIN_SCORE = 0.6
+
+def _city_trigrams(name):
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _build_city_trigram_index(states):
+    """
+    Index the city names of a city -> ZIP index by character trigram.
+
+    Returns:
+        dict: names [(city, state, trigram count, zip count)], by_state {state: {trigram:
+            [name positions]}} and all {trigram: [name positions]}
+    """
+    names = []
+    by_state = {}
+    everywhere = {}
+    for state, cities in states.items():
+        postings = by_state.setdefault(state, {})
+        for city, zips in cities.items():
+            position = len(names)
+            trigrams = _city_trigrams(city)
+            names.append((city, state, len(trigrams), len(zips)))
+            for trigram in trigrams:
+                postings.setdefault(trigram, []).append(position)
+                everywhere.setdefault(trigram, []).append(position)
+    return {'names': names, 'by_state': by_state, 'all': everywhere}
+
+def _get_city_trigram_index():
+    states = _get_city_zip_index()['states']
+    return _get_cached_index('city_trigrams', _file_version(CITY_ZIP_INDEX_FILE),
+                             lambda: _build_city_trigram_index(states))
+
+def _fuzzy_match_city(index, city, state=None, limit=1):
+    """
+    Closest indexed cities to a name, optionally within one state.
+
+    Returns:
+        list: (score, city, state) tuples scoring at least FUZZY_CITY_MIN_SCORE, best
+            first; ties go to the city with more ZIP codes
+    """
+    trigrams = _city_trigrams(_normalize_city_name(city))
+    postings = index['by_state'].get(state.upper(), {}) if state else index['all']
+    shared = Counter()
+    for trigram in trigrams:
+        shared.update(postings.get(trigram, ()))
+    matches = []
+    for position, count in shared.items():
+        name, name_state, size, zip_count = index['names'][position]
+        score = 2 * count / (len(trigrams) + size)
+        if score >= FUZZY_CITY_MIN_SCORE:
+            matches.append((-score, -zip_count, name, name_state))
+    matches.sort()
+    return [(-score, name, name_state) for score, _, name, name_state in matches[:limit]]
+
+# Typeahead for the search page's city picker: every US place sorted by normalized name,
+# so a prefix is a bisect range. Places are ranked by ZIP count (the postal table has no
+# population); the top results for one- and two-letter prefixes are precomputed.
+CITY_SUGGEST_LIMIT = 50
+_CITY_SUGGEST_PRECOMPUTED_PREFIX = 2
+
+def _build_city_prefix_index():
+    """
+    Sort the US places for prefix search.
+
+    Returns:
+        dict: keys [normalized names, sorted], places [(name, state, zip count)] aligned
+            with keys and top {short prefix: [place positions, most ZIP codes first]}
+    """
+    postal = _get_postal_data()
+    if postal is None:
+        return {'keys': [], 'places': [], 'top': {}}
+    places = (postal['frame'].groupby(['city_key', 'state_upper'])
+              .agg(name=('place_name', 'first'), zip_count=('zip', 'nunique'))
+              .reset_index()
+              .sort_values(['city_key', 'zip_count', 'state_upper'], ascending=[True, False, True]))
+    keys = places['city_key'].tolist()
+    entries = list(zip(places['name'], places['state_upper'], places['zip_count'].astype(int).tolist()))
+    prefixes = {}
+    for position, key in enumerate(keys):
+        for length in range(1, _CITY_SUGGEST_PRECOMPUTED_PREFIX + 1):
+            prefixes.setdefault(key[:length], []).append(position)
+    top = {prefix: heapq.nsmallest(CITY_SUGGEST_LIMIT, positions, key=lambda p: (-entries[p][2], p))
+           for prefix, positions in prefixes.items()}
+    return {'keys': keys, 'places': entries, 'top': top}
+
+def _get_city_prefix_index():
+    return _get_cached_index('city_prefix', _get_postal_data() is not None, _build_city_prefix_index)
+
+def _suggest_cities(index, query, state=None, limit=10):
+    """Places whose normalized name starts with query, most ZIP codes first: [(name, state, zip count)]."""
+    # "st" may be typed as the start of "sterling" as well as for "saint"
+    raw = ' '.join(re.sub(r"[.'’]", '', str(query).casefold()).replace('-', ' ').split())
+    prefixes = {prefix for prefix in (raw, _normalize_city_name(query)) if prefix}
+    keys = index['keys']
+    ranked = []
+    for prefix in prefixes:
+        if not state and prefix in index['top']:
+            ranked.extend(index['top'][prefix])
+            continue
+        start = bisect.bisect_left(keys, prefix)
+        end = bisect.bisect_left(keys, prefix + '\uffff', start)
+        ranked.extend(position for position in range(start, end)
+                      if not state or index['places'][position][1] == state.upper())
+    places = index['places']
+    return [places[position] for position in heapq.nsmallest(limit, set(ranked), key=lambda p: (-places[p][2], p))]
+
+# Zippopotam lookups share one pooled session, run ZIPPOPOTAM_WORKERS at a time and are
+# remembered in ZIPPOPOTAM_CACHE_FILE ({"ST|normalized city": [zips]}), so re-uploads
+# never refetch a known city.
+ZIPPOPOTAM_CACHE_FILE = os.path.join(DATA_DIR, 'zippopotam_cache.json')
+ZIPPOPOTAM_CACHE_LOCK_FILE = ZIPPOPOTAM_CACHE_FILE + '.lock'
+try:
+    ZIPPOPOTAM_WORKERS = int(os.getenv('ZIPPOPOTAM_WORKERS', '8'))
+except ValueError:
+    ZIPPOPOTAM_WORKERS = 8
+ZIPPOPOTAM_SESSION = requests.Session()
+ZIPPOPOTAM_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=ZIPPOPOTAM_WORKERS))
+
+def _zippopotam_cache_key(state_abbr, city_name):
+    return f"{state_abbr.upper()}|{_normalize_city_name(city_name)}"
+
+def _load_zippopotam_cache():
+    if not os.path.exists(ZIPPOPOTAM_CACHE_FILE):
+        return {}
+    try:
+        with open(ZIPPOPOTAM_CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def _zips_from_zippopotam(state_abbr: str, city_name: str):
+    """ZIPs for a city from api.zippopotam.us (requires state); [] when it has none, None on network errors."""
+    try:
+        from urllib.parse import quote
+        url = f"https://api.zippopotam.us/us/{state_abbr.lower()}/{quote(city_name)}"
+        resp = ZIPPOPOTAM_SESSION.get(url, timeout=10)
+        if resp.status_code == 404:
+            return []
+        if resp.status_code != 200:
+            return None
+        data = resp.json()
+        out = []
+        for p in data.get('places', []) or []:
+            z = p.get('post code') or p.get('postcode') or p.get('post_code') or p.get('postal_code')
+            if z:
+                out.append(str(z))
+        return out
+    except Exception:
+        return None
+
+def _zippopotam_lookup_many(cities):
+    """
+    ZIPs for many (state, city) pairs: cached answers first, the rest fetched concurrently.
+
+    Definitive answers (including "no ZIPs") are cached; network failures are not.
+
+    Returns:
+        dict: {(state, city): [zips]}, [] for failed lookups
+    """
+    cache = _load_zippopotam_cache()
+    results = {}
+    missing = []
+    for state, city in dict.fromkeys(cities):
+        key = _zippopotam_cache_key(state, city)
+        if key in cache:
+            results[(state, city)] = cache[key]
+        else:
+            missing.append((state, city))
+
+    if missing:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max(1, ZIPPOPOTAM_WORKERS)) as executor:
+            fetched = list(executor.map(lambda pair: _zips_from_zippopotam(*pair), missing))
+        answers = {}
+        for (state, city), zips in zip(missing, fetched):
+            results[(state, city)] = zips or []
+            if zips is not None:
+                answers[_zippopotam_cache_key(state, city)] = zips
+        # Merge into the file as it is now, so concurrent uploads keep each other's entries
+        with _file_lock(ZIPPOPOTAM_CACHE_LOCK_FILE):
+            cache = _load_zippopotam_cache()
+            cache.update(answers)
+            _write_json_atomic(ZIPPOPOTAM_CACHE_FILE, cache)
+        logger.info(f"Zippopotam: {len(results) - len(missing)} cached, {len(missing)} fetched, "
+                    f"{sum(1 for zips in fetched if zips is None)} failed")
+    return results
+
 @app.route('/markets', methods=['GET', 'POST'])
 def markets():
     """Live Markets page with CSV upload and simple visualization of first two columns.
@@ -633,41 +1513,25 @@ def markets():
         file = request.files.get('csv_file')
         if not file or not file.filename:
             flash('Please choose a CSV file to upload.', 'warning')
-            return render_template('markets.html', headers=headers, rows=table_rows, api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
+            return render_template('markets.html', headers=headers, rows=_with_coordinates(table_rows, 'Zip Codes'), api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
 
         if not allowed_file(file.filename):
             flash('Only .csv files are allowed.', 'error')
-            return render_template('markets.html', headers=headers, rows=table_rows, api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
+            return render_template('markets.html', headers=headers, rows=_with_coordinates(table_rows, 'Zip Codes'), api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
 
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
         try:
-            df = pd.read_csv(filepath)
-            nomi = pgeocode.Nominatim('us')
-            city_state_entries = df.iloc[:, 0].dropna().astype(str).str.strip()
+            # Parse straight from the upload stream in chunks, keeping only the first column
+            chunks = pd.read_csv(file.stream, usecols=[0], chunksize=MARKETS_CSV_CHUNK_ROWS)
+            city_state_entries = pd.concat([chunk.iloc[:, 0].dropna().astype(str).str.strip() for chunk in chunks])
             zip_city_rows = []
+            resolved_cities = []
+            zippopotam_lookups = []
 
-            # Helper: pull zips from Zippopotam (requires state), fallback to pgeocode
-            def zips_from_zippopotam(state_abbr: str, city_name: str):
-                try:
-                    from urllib.parse import quote
-                    url = f"https://api.zippopotam.us/us/{state_abbr.lower()}/{quote(city_name)}"
-                    resp = requests.get(url, timeout=10)
-                    if resp.status_code != 200:
-                        return []
-                    data = resp.json()
-                    out = []
-                    for p in data.get('places', []) or []:
-                        z = p.get('post code') or p.get('postcode') or p.get('post_code') or p.get('postal_code')
-                        pn = p.get('place name') or p.get('place_name') or city_name
-                        if z:
-                            out.append({'Zip Code': str(z), 'City': str(pn)})
-                    return out
-                except Exception:
-                    return []
-
-            geo_df = nomi._data
+            # Cities already in the current upload keep their resolved ZIPs; only new ones are looked up
+            current_upload = (_load_markets_db() or [None])[-1]
+            previous_rows = {(row.get('City', ''), row.get('State', '')): row
+                             for row in (current_upload or {}).get('data', [])}
             for entry in city_state_entries.unique():
                 if not entry:
                     continue
@@ -678,109 +1542,38 @@ def markets():
                     city = parts[0].strip()
                     state = parts[1].strip().upper()
                 else:
-                    # Fallback: treat as city only and find states from pgeocode
+                    # Fallback: treat as city only and pick its state from the ranking table
                     city = entry
-                    
-                    # First, try well-known major city mappings
-                    major_cities = {
-                        'houston': 'TX', 'dallas': 'TX', 'san antonio': 'TX', 'austin': 'TX', 'fort worth': 'TX',
-                        'phoenix': 'AZ', 'tucson': 'AZ', 'mesa': 'AZ', 'chandler': 'AZ',
-                        'los angeles': 'CA', 'san diego': 'CA', 'san jose': 'CA', 'san francisco': 'CA',
-                        'fresno': 'CA', 'sacramento': 'CA', 'long beach': 'CA', 'oakland': 'CA',
-                        'chicago': 'IL', 'aurora': 'IL', 'rockford': 'IL', 'joliet': 'IL',
-                        'philadelphia': 'PA', 'pittsburgh': 'PA', 'allentown': 'PA', 'erie': 'PA',
-                        'new york': 'NY', 'buffalo': 'NY', 'rochester': 'NY', 'yonkers': 'NY',
-                        'miami': 'FL', 'tampa': 'FL', 'orlando': 'FL', 'st. petersburg': 'FL',
-                        'atlanta': 'GA', 'augusta': 'GA', 'columbus': 'GA', 'savannah': 'GA',
-                        'nashville': 'TN', 'memphis': 'TN', 'knoxville': 'TN', 'chattanooga': 'TN',
-                        'denver': 'CO', 'colorado springs': 'CO', 'aurora': 'CO', 'fort collins': 'CO',
-                        'seattle': 'WA', 'spokane': 'WA', 'tacoma': 'WA', 'vancouver': 'WA',
-                        'portland': 'OR', 'salem': 'OR', 'eugene': 'OR', 'gresham': 'OR',
-                        'las vegas': 'NV', 'henderson': 'NV', 'reno': 'NV', 'north las vegas': 'NV',
-                        'boston': 'MA', 'worcester': 'MA', 'springfield': 'MA', 'cambridge': 'MA',
-                        'detroit': 'MI', 'grand rapids': 'MI', 'warren': 'MI', 'sterling heights': 'MI',
-                        'minneapolis': 'MN', 'saint paul': 'MN', 'rochester': 'MN', 'duluth': 'MN',
-                        'kansas city': 'MO', 'saint louis': 'MO', 'springfield': 'MO', 'independence': 'MO',
-                        'cleveland': 'OH', 'cincinnati': 'OH', 'toledo': 'OH', 'akron': 'OH',
-                        'columbus': 'OH', 'dayton': 'OH', 'parma': 'OH', 'canton': 'OH',
-                        'indianapolis': 'IN', 'fort wayne': 'IN', 'evansville': 'IN', 'south bend': 'IN',
-                        'milwaukee': 'WI', 'madison': 'WI', 'green bay': 'WI', 'kenosha': 'WI',
-                        'baltimore': 'MD', 'frederick': 'MD', 'rockville': 'MD', 'gaithersburg': 'MD',
-                        'charlotte': 'NC', 'raleigh': 'NC', 'greensboro': 'NC', 'durham': 'NC',
-                        'virginia beach': 'VA', 'norfolk': 'VA', 'chesapeake': 'VA', 'richmond': 'VA',
-                        'salt lake city': 'UT', 'west valley city': 'UT', 'provo': 'UT', 'west jordan': 'UT',
-                        'oklahoma city': 'OK', 'tulsa': 'OK', 'norman': 'OK', 'broken arrow': 'OK',
-                        'louisville': 'KY', 'lexington': 'KY', 'bowling green': 'KY', 'owensboro': 'KY',
-                        'new orleans': 'LA', 'baton rouge': 'LA', 'shreveport': 'LA', 'lafayette': 'LA',
-                        'albuquerque': 'NM', 'las cruces': 'NM', 'rio rancho': 'NM', 'santa fe': 'NM',
-                        'omaha': 'NE', 'lincoln': 'NE', 'bellevue': 'NE', 'grand island': 'NE',
-                        'wichita': 'KS', 'overland park': 'KS', 'kansas city': 'KS', 'topeka': 'KS',
-                        'des moines': 'IA', 'cedar rapids': 'IA', 'davenport': 'IA', 'sioux city': 'IA',
-                        'little rock': 'AR', 'fort smith': 'AR', 'fayetteville': 'AR',
-                        'jackson': 'MS', 'gulfport': 'MS', 'southaven': 'MS', 'hattiesburg': 'MS',
-                        'birmingham': 'AL', 'montgomery': 'AL', 'mobile': 'AL', 'huntsville': 'AL',
-                        'anchorage': 'AK', 'fairbanks': 'AK', 'juneau': 'AK',
-                        'honolulu': 'HI', 'pearl city': 'HI', 'hilo': 'HI',
-                        'boise': 'ID', 'nampa': 'ID', 'meridian': 'ID', 'idaho falls': 'ID',
-                        'billings': 'MT', 'missoula': 'MT', 'great falls': 'MT', 'bozeman': 'MT',
-                        'fargo': 'ND', 'bismarck': 'ND', 'grand forks': 'ND', 'minot': 'ND',
-                        'sioux falls': 'SD', 'rapid city': 'SD', 'aberdeen': 'SD', 'brookings': 'SD',
-                        'cheyenne': 'WY', 'casper': 'WY', 'laramie': 'WY', 'gillette': 'WY',
-                        'burlington': 'VT', 'essex': 'VT', 'south burlington': 'VT', 'colchester': 'VT',
-                        'concord': 'NH', 'manchester': 'NH', 'nashua': 'NH', 'derry': 'NH',
-                        'providence': 'RI', 'warwick': 'RI', 'cranston': 'RI', 'pawtucket': 'RI',
-                        'hartford': 'CT', 'bridgeport': 'CT', 'new haven': 'CT', 'stamford': 'CT',
-                        'dover': 'DE', 'wilmington': 'DE',
-                        'annapolis': 'MD', 'bowie': 'MD', 'hagerstown': 'MD',
-                        'charleston': 'WV', 'huntington': 'WV', 'parkersburg': 'WV', 'morgantown': 'WV',
-                        'columbia': 'SC', 'charleston': 'SC', 'north charleston': 'SC', 'mount pleasant': 'SC',
-                        'tallahassee': 'FL', 'fort lauderdale': 'FL', 'port st. lucie': 'FL', 'cape coral': 'FL',
-                        'washington': 'DC'
-                    }
-                    
-                    city_lower = city.lower().strip()
-                    if city_lower in major_cities:
-                        state = major_cities[city_lower]
-                        logger.info(f"Using known mapping: {city} -> {state}")
-                    else:
-                        # Fall back to pgeocode lookup
-                        mask_city = geo_df['place_name'].str.casefold() == city.casefold()
-                        cand_states = (
-                            geo_df.loc[mask_city, 'state_code']
-                            .dropna()
-                            .astype(str)
-                            .str.upper()
-                            .unique()
-                            .tolist()
-                        )
-                        if not cand_states:
+                    cand_states = _rank_city_states(_get_city_state_table(), city)
+                    if not cand_states:
+                        match = _fuzzy_match_city(_get_city_trigram_index(), city)
+                        if not match:
                             continue
-                            
-                        # Use the most common state for this city (by count of zip codes)
-                        state_counts = geo_df.loc[mask_city, 'state_code'].value_counts()
-                        if len(state_counts) > 0:
-                            state = state_counts.index[0].upper()  # Most common state
-                            logger.info(f"Using most common state from pgeocode: {city} -> {state}")
-                        else:
-                            state = cand_states[0]  # Fallback to first found
-                            logger.info(f"Using first found state from pgeocode: {city} -> {state}")
+                        cand_states = [match[0][2]]
+                    state = cand_states[0]
+                    logger.info(f"Using {state} for {city} (of {len(cand_states)} candidate states)")
                 
-                # Collect all ZIP codes for this city
-                zip_codes = set()
-                
-                # Try Zippopotam first with the parsed state
-                rows = zips_from_zippopotam(state, city)
-                if rows:
-                    for row in rows:
-                        zip_codes.add(row['Zip Code'])
-                else:
-                    # Fallback: pgeocode only
-                    mask_city = geo_df['place_name'].str.casefold() == city.casefold()
-                    mask_state = geo_df['state_code'].str.upper() == state
-                    combined_mask = mask_city & mask_state
-                    res = geo_df.loc[combined_mask, ['postal_code']].dropna().drop_duplicates()
-                    for _, r in res.iterrows():
-                        zip_codes.add(str(r['postal_code']))
+                previous_row = previous_rows.get((city, state))
+                if previous_row is not None:
+                    resolved_cities.append((city, state, {z.strip() for z in previous_row['Zip Codes'].split(',') if z.strip()}))
+                    continue
+
+                # Collect all ZIP codes for this city from the offline index; Zippopotam
+                # fills misses and, when enabled, adds ZIPs the index does not know
+                zip_codes = set(_resolve_city_zips(city, state))
+                if not zip_codes:
+                    match = _fuzzy_match_city(_get_city_trigram_index(), city, state)
+                    if match:
+                        score, matched_city, _ = match[0]
+                        zip_codes = set(_resolve_city_zips(matched_city, state))
+                        logger.info(f"Fuzzy matched {city}, {state} -> {matched_city} (score {score:.2f})")
+                if not zip_codes or ZIPPOPOTAM_ENRICHMENT:
+                    zippopotam_lookups.append((state, city))
+                resolved_cities.append((city, state, zip_codes))
+
+            zippopotam_zips = _zippopotam_lookup_many(zippopotam_lookups) if zippopotam_lookups else {}
+            for city, state, zip_codes in resolved_cities:
+                zip_codes.update(zippopotam_zips.get((state, city), []))
                 
                 # Create single row with comma-separated ZIP codes
                 if zip_codes:
@@ -791,7 +1584,9 @@ def markets():
                     })
 
             table_rows = zip_city_rows
-            flash(f'Found {len(table_rows)} ZIP entries from {len(city_state_entries.unique())} cities.', 'success')
+            delta = _markets_upload_delta(current_upload, table_rows)
+            flash(f'Found {len(table_rows)} ZIP entries from {len(city_state_entries.unique())} cities '
+                  f'({len(delta["added"])} added, {len(delta["removed"])} removed).', 'success')
             
             # Save to both session (for immediate use) and file-based database (for persistence)
             session['markets_rows'] = table_rows
@@ -803,252 +1598,1342 @@ def markets():
                 'data': table_rows,
                 'total_entries': len(table_rows),
                 'total_cities': len(city_state_entries.unique()),
-                'date_uploaded': datetime.now().isoformat()
+                'date_uploaded': datetime.now().isoformat(),
+                'delta': delta
             }
             
-            # Load existing markets data and add new entry
-            existing_markets = _load_markets_db()
-            existing_markets.append(markets_entry)
-            _save_markets_db(existing_markets)
+            # New upload becomes current; earlier uploads move to the archive
+            _add_markets_upload(markets_entry)
             
             logger.info(f"Cached {len(table_rows)} Live Markets entries in session and saved to persistent database")
         except Exception as e:
             flash(f'Error reading CSV: {e}', 'error')
-        finally:
-            if os.path.exists(filepath):
-                os.remove(filepath)
 
-    return render_template('markets.html', headers=headers, rows=table_rows, api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
+    return render_template('markets.html', headers=headers, rows=_with_coordinates(table_rows, 'Zip Codes'), api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
+
+@app.route('/clear-markets', methods=['POST'])
+def clear_markets():
+    """Clear all markets data from session and persistent storage."""
+    try:
+        # Clear from session
+        session.pop('markets_rows', None)
+        
+        # Clear from persistent storage, including archived uploads
+        _save_markets_db([])
+        _save_markets_archive([])
+        
+        logger.info("Cleared all markets data from session and persistent storage")
+        return jsonify({'success': True, 'message': 'All markets data cleared successfully'})
+    
+    except Exception as e:
+        logger.error(f"Error clearing markets data: {e}")
+        return jsonify({'success': False, 'error': str(e)})
+
+def _extract_zip_from_address(address: str) -> str:
+    if not address:
+        return ''
+    m = re.search(r"\b(\d{5})(?:-\d{4})?\b", address)
+    return m.group(1) if m else ''
+
+# Canonical business_status values stored on every store record
+STORE_STATUSES = ('OPERATIONAL', 'CLOSED_TEMPORARILY', 'CLOSED_PERMANENTLY', 'UNKNOWN')
+_STORE_STATUS_ALIASES = {
+    'permanently_closed': 'CLOSED_PERMANENTLY',
+    'temporarily_closed': 'CLOSED_TEMPORARILY',
+    'open': 'OPERATIONAL',
+}
+
+def _clean_text(value) -> str:
+    """Return value as a stripped string, treating None/NaN (and pandas' 'nan') as empty."""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value != value:
+        return ''
+    text = str(value).strip()
+    return '' if text.lower() in ('nan', 'none') else text
+
+def _clean_float(value) -> float:
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return number if number == number else 0.0
+
+def _normalize_zip(value) -> str:
+    """Return a canonical 5-digit ZIP from a zip field that may be numeric, ZIP+4 or missing leading zeros."""
+    text = _clean_text(value)
+    if text.endswith('.0'):
+        text = text[:-2]
+    m = re.match(r"^(\d{1,5})(?:-\d{4})?$", text)
+    return m.group(1).zfill(5) if m else ''
+
+def _normalize_business_status(status) -> str:
+    key = _clean_text(status).lower()
+    if not key:
+        return 'OPERATIONAL'
+    canonical = _STORE_STATUS_ALIASES.get(key, key.upper())
+    return canonical if canonical in STORE_STATUSES else 'UNKNOWN'
+
+_US_STATE_CODES = {
+    'alabama': 'AL', 'alaska': 'AK', 'arizona': 'AZ', 'arkansas': 'AR', 'california': 'CA',
+    'colorado': 'CO', 'connecticut': 'CT', 'delaware': 'DE', 'district of columbia': 'DC',
+    'florida': 'FL', 'georgia': 'GA', 'hawaii': 'HI', 'idaho': 'ID', 'illinois': 'IL',
+    'indiana': 'IN', 'iowa': 'IA', 'kansas': 'KS', 'kentucky': 'KY', 'louisiana': 'LA',
+    'maine': 'ME', 'maryland': 'MD', 'massachusetts': 'MA', 'michigan': 'MI', 'minnesota': 'MN',
+    'mississippi': 'MS', 'missouri': 'MO', 'montana': 'MT', 'nebraska': 'NE', 'nevada': 'NV',
+    'new hampshire': 'NH', 'new jersey': 'NJ', 'new mexico': 'NM', 'new york': 'NY',
+    'north carolina': 'NC', 'north dakota': 'ND', 'ohio': 'OH', 'oklahoma': 'OK', 'oregon': 'OR',
+    'pennsylvania': 'PA', 'rhode island': 'RI', 'south carolina': 'SC', 'south dakota': 'SD',
+    'tennessee': 'TN', 'texas': 'TX', 'utah': 'UT', 'vermont': 'VT', 'virginia': 'VA',
+    'washington': 'WA', 'west virginia': 'WV', 'wisconsin': 'WI', 'wyoming': 'WY',
+    'puerto rico': 'PR', 'washington dc': 'DC', 'washington d.c.': 'DC',
+}
+
+def _normalize_state(value) -> str:
+    """Two-letter code for a state code or full state name ("Texas" -> "TX"), or ''."""
+    value = _clean_text(value)
+    if re.match(r'^[A-Za-z]{2}$', value):
+        return value.upper()
+    return _US_STATE_CODES.get(' '.join(value.lower().split()), '')
+
+def _normalize_store(store):
+    """
+    Return a copy of a store record with canonical location and status fields.
+
+    Stores are normalized once when written (and backfilled by migration), so
+    read paths use zip_code/city/state directly instead of parsing addresses.
+
+    Args:
+        store (dict): Store record from a search, CSV upload or the legacy flat shape
+
+    Returns:
+        dict: Store with zip_code (5 digits or ''), city, state (2 letters where the
+            value or address names a state, else the value as given), float
+            latitude/longitude and a business_status from STORE_STATUSES
+    """
+    normalized = dict(store)
+    address = _clean_text(store.get('formatted_address')) or _clean_text(store.get('address'))
+
+    street, parsed_city, parsed_state, parsed_zip = _parse_address_components(address)
+    zip_code = _extract_zip_from_address(address) or _normalize_zip(store.get('zip_code')) or _normalize_zip(parsed_zip)
+    city = _clean_text(store.get('city')) or parsed_city
+    raw_state = _clean_text(store.get('state'))
+    state = _normalize_state(raw_state) or _normalize_state(parsed_state) or raw_state
+
+    normalized.update({
+        'name': _clean_text(store.get('name')),
+        'zip_code': zip_code,
+        'city': city,
+        'state': state,
+        'latitude': _clean_float(store.get('latitude')),
+        'longitude': _clean_float(store.get('longitude')),
+        'business_status': _normalize_business_status(store.get('business_status')),
+    })
+    return normalized
+
+def _count_cities(stores) -> int:
+    return len({store.get('city', '').strip() for store in stores if store.get('city', '').strip()})
+
+def _store_key(store):
+    """Identity of a store for dedupe: its Google place_id, or name + ZIP + address for uploaded rows."""
+    place_id = store.get('place_id') or ''
+    if place_id and not place_id.startswith('uploaded_'):
+        return place_id
+    address = (store.get('formatted_address') or store.get('address') or '').strip().lower()
+    return f"{store.get('name', '').strip().lower()}|{store.get('zip_code', '')}|{address}"
+
+def _stores_content_hash(retailer_name, stores):
+    """Order-independent SHA-256 of a retailer's store set, used to detect repeated saves."""
+    keys = sorted(_store_key(store) for store in stores)
+    payload = json.dumps([retailer_name.strip().lower(), keys])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class _HashingReader:
+    """Read-through wrapper for a binary upload stream that hashes the bytes as they are read."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha = hashlib.sha256()
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.sha.update(chunk)
+        return chunk
+
+    def __iter__(self):
+        return iter(lambda: self.read(1 << 16), b'')
+
+    def hexdigest(self):
+        """SHA-256 of the whole stream, reading whatever the consumer left unread."""
+        for _ in self:
+            pass
+        return self.sha.hexdigest()
+
+def _merge_stores(existing_stores, new_stores):
+    """Append stores from new_stores whose _store_key is not already present. Returns the stores added."""
+    seen = {_store_key(store) for store in existing_stores}
+    added = []
+    for store in new_stores:
+        key = _store_key(store)
+        if key not in seen:
+            existing_stores.append(store)
+            seen.add(key)
+            added.append(store)
+    return added
+
+def _compact_retailer_data(retailer_data):
+    """
+    Collapse duplicate retailer entries left by repeated saves and uploads.
+
+    Entries with the same retailer name and removed flag are merged into the
+    oldest one, keeping each store (by _store_key) once.
+
+    Returns:
+        tuple: (compacted retailer list, number of entries merged away)
+    """
+    compacted = []
+    by_name = {}
+    for retailer in retailer_data:
+        group = (retailer.get('retailer_name', '').strip().lower(), bool(retailer.get('removed', False)))
+        target = by_name.get(group)
+        if target is None:
+            retailer['stores'] = list(retailer.get('stores', []))
+            by_name[group] = retailer
+            compacted.append(retailer)
+            continue
+        _merge_stores(target['stores'], retailer.get('stores', []))
+
+    for retailer in compacted:
+        retailer['total_stores'] = len(retailer['stores'])
+        retailer['total_cities'] = _count_cities(retailer['stores'])
+        retailer['content_hash'] = _stores_content_hash(retailer.get('retailer_name', ''), retailer['stores'])
+
+    return compacted, len(retailer_data) - len(compacted)
+
+# Lookup indexes derived from the retailer database / markets upload. Each
+# name keeps only the index for the latest data version it was built from.
+DATA_INDEX_CACHE = {}
+
+def _file_version(path):
+    """Cheap version stamp for a data file: (mtime_ns, size), or None if missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _markets_rows_version(markets_rows):
+    """Content version of a markets table (rows may come from the session rather than a file)."""
+    payload = json.dumps(markets_rows, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def _get_cached_index(name, version, build):
+    """Return the index called name for this data version, building it with build() on a miss."""
+    cached = DATA_INDEX_CACHE.get(name)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    index = build()
+    DATA_INDEX_CACHE[name] = (version, index)
+    return index
+
+def _build_market_zip_index(markets_rows):
+    """Map each market ZIP to the first markets row listing it: {zip: {'city', 'state', 'market'}}."""
+    index = {}
+    for position, row in enumerate(markets_rows):
+        zip_codes_str = (row.get('Zip Codes') or row.get('Zip Code') or '').strip()
+        if not zip_codes_str:
+            continue
+        city = (row.get('City') or '').strip()
+        state = (row.get('State') or '').strip()
+        for zip_code in zip_codes_str.split(','):
+            zip_code = zip_code.strip()
+            if zip_code and zip_code not in index:
+                index[zip_code] = {'city': city, 'state': state, 'market': position}
+    return index
+
+def _build_store_location_index(retailer_records):
+    """Map each store ZIP to the most common non-empty city and state among stores in that ZIP."""
+    return _store_locations_from_counts(_count_stores(retailer_records)['locations'])
+
+def _most_common(counts):
+    # Most stores wins; ties go to the alphabetically first value so the pick is stable
+    return min(counts.items(), key=lambda item: (-item[1], item[0]))[0]
+
+def _store_locations_from_counts(locations):
+    """Pick one city and state per ZIP from the view's {zip: {'cities', 'states'}} counts."""
+    index = {}
+    for zip_code, counts in locations.items():
+        location = index.setdefault(zip_code, {})
+        if counts.get('cities'):
+            location['city'] = _most_common(counts['cities'])
+        if counts.get('states'):
+            location['state'] = _most_common(counts['states'])
+    return index
+
+def _get_market_zip_index(markets_rows):
+    return _get_cached_index('market_zip', _markets_rows_version(markets_rows),
+                             lambda: _build_market_zip_index(markets_rows))
+
+def _get_store_location_index(view):
+    # Keyed by the database version the view was built or patched for
+    return _get_cached_index('store_location', view['db_version'],
+                             lambda: _store_locations_from_counts(view['locations']))
+
+# Materialized view of the stored stores, so analysis never rescans the database:
+#   zips       {zip: {store name: count}}
+#   locations  {zip: {'cities': {city: count}, 'states': {state: count}}}
+#   cities     {state: {city: {store name: count}}}  (city rollup)
+# Keys are sorted at every level so a patched view matches a rebuilt one. Writers update
+# it incrementally via _save_db_incremental; any other write leaves it stale and the next
+# read rebuilds it. Bump RETAILER_VIEW_FORMAT when the layout changes.
+RETAILER_VIEW_FILE = os.path.join(DATA_DIR, 'retailer_by_zip.json')
+RETAILER_VIEW_FORMAT = 2
+
+def _count_stores(retailer_records):
+    """Count every stored store into the view's zips, locations and cities maps."""
+    counts = {'zips': {}, 'locations': {}, 'cities': {}}
+    for retailer_entry in retailer_records:
+        _apply_store_counts(counts, retailer_entry.get('stores', []), 1)
+    return {field: _sorted_counts(value) for field, value in counts.items()}
+
+def _count_retailers_by_zip(retailer_records):
+    """Count stores per ZIP and store name by scanning every stored store."""
+    return _count_stores(retailer_records)['zips']
+
+def _bump_count(counts, path, sign):
+    """Add sign to the count at counts[path[0]]...[path[-1]], dropping entries that reach zero."""
+    key = path[0]
+    if len(path) == 1:
+        counts[key] = counts.get(key, 0) + sign
+        if counts[key] <= 0:
+            del counts[key]
+        return
+    child = counts.setdefault(key, {})
+    _bump_count(child, path[1:], sign)
+    if not child:
+        del counts[key]
+
+def _apply_store_counts(view, stores, sign):
+    """Add (sign=1) or subtract (sign=-1) stores from the view's count maps."""
+    for store in stores:
+        # Stores are normalized at write time, so zip_code is already a canonical ZIP5
+        zip_code = store.get('zip_code', '')
+        name = store.get('name', '')
+        city = store.get('city', '')
+        state = store.get('state', '')
+        if zip_code and name:
+            _bump_count(view['zips'], (zip_code, name), sign)
+        if zip_code and city:
+            _bump_count(view['locations'], (zip_code, 'cities', city), sign)
+        if zip_code and state:
+            _bump_count(view['locations'], (zip_code, 'states', state), sign)
+        if city and name:
+            _bump_count(view['cities'], (state, city, name), sign)
+
+def _sorted_counts(counts):
+    # Analysis walks ZIPs in dict order (a city takes the state of its first ZIP and
+    # ties keep that order), so the order must not depend on the history of writes
+    return {key: _sorted_counts(value) if isinstance(value, dict) else value
+            for key, value in sorted(counts.items())}
+
+def _build_retailer_view(retailer_records):
+    return {'format': RETAILER_VIEW_FORMAT, 'db_version': list(_file_version(DB_FILE) or []),
+            **_count_stores(retailer_records)}
+
+def _patch_retailer_view(view, added_stores=(), removed_stores=()):
+    """Apply a store delta to a view in place, leaving it identical to a rebuild."""
+    _apply_store_counts(view, removed_stores, -1)
+    _apply_store_counts(view, added_stores, 1)
+    for field in ('zips', 'locations', 'cities'):
+        view[field] = _sorted_counts(view[field])
+    return view
+
+def _retailer_view_is_current(view, db_version):
+    return view is not None and view.get('format') == RETAILER_VIEW_FORMAT and view.get('db_version') == db_version
+
+def _read_retailer_view_file():
+    if not os.path.exists(RETAILER_VIEW_FILE):
+        return None
+    try:
+        with open(RETAILER_VIEW_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+def _load_retailer_view(retailer_records=None):
+    """Return the materialized view for the current database, rebuilding it if stale."""
+    current_version = list(_file_version(DB_FILE) or [])
+    cached = DATA_INDEX_CACHE.get('retailer_view')
+    if cached is not None and cached[0] == current_version:
+        return cached[1]
+
+    view = _read_retailer_view_file()
+    if not _retailer_view_is_current(view, current_version):
+        if retailer_records is None:
+            retailer_records = _load_db()
+        view = _build_retailer_view(retailer_records)
+        _write_json_atomic(RETAILER_VIEW_FILE, view)
+        logger.info(f"Rebuilt retailer_by_zip view: {len(view['zips'])} zip codes")
+    DATA_INDEX_CACHE['retailer_view'] = (current_version, view)
+    return view
+
+def _save_db_incremental(records, added_stores=(), removed_stores=()):
+    """Save the retailer database and apply the store delta to the materialized view.
+
+    The view is only patched if it matched the database before this write;
+    otherwise it is left stale and rebuilt on the next read.
+    """
+    view = _read_retailer_view_file()
+    was_current = _retailer_view_is_current(view, list(_file_version(DB_FILE) or []))
+    _save_db(records)
+    if not was_current:
+        return
+    _patch_retailer_view(view, added_stores, removed_stores)
+    view['db_version'] = list(_file_version(DB_FILE) or [])
+    _write_json_atomic(RETAILER_VIEW_FILE, view)
+    DATA_INDEX_CACHE['retailer_view'] = (view['db_version'], view)
+
+def _run_analysis(retailer_records, markets_rows, retailer_by_zip=None, store_location_index=None):
+    """
+    Aggregate stored retailer locations by city and flag cities in the markets list.
+
+    Args:
+        retailer_records (list): Retailer entries from the database; only read
+            for whichever of the two precomputed maps below is omitted
+        markets_rows (list): Markets rows with City, State and comma-separated Zip Codes
+        retailer_by_zip (dict): Precomputed {zip: {store name: count}} (the
+            materialized view); counted from retailer_records when omitted
+        store_location_index (dict): Precomputed {zip: {'city', 'state'}} (from the
+            view's locations); built from retailer_records when omitted
+
+    Returns:
+        list: One dict per city (City, State, Prioritized Zip Codes, Retailers,
+            Total Stores, Is Reflex Market), most stores first
+    """
+    results = []
+
+    # Map retailer locations by ZIP -> dict of retailer names and their counts
+    if retailer_by_zip is None:
+        retailer_by_zip = _count_retailers_by_zip(retailer_records)
+    logger.info(f"Retailer processing: {len(retailer_by_zip)} unique zip codes")
+
+    # ZIP lookups for markets and stored retailer locations
+    market_index = _get_market_zip_index(markets_rows)
+    if store_location_index is None:
+        store_location_index = _build_store_location_index(retailer_records)
+    
+    # Group retailer locations by city -> aggregate all retailers and stores per city
+    city_aggregated_data = {}
+    matched_zips = 0
+    unmatched_zips = 0
+    
+    for zip_code, retailers in retailer_by_zip.items():
+        market = market_index.get(zip_code)
+        store_location = store_location_index.get(zip_code, {})
+        
+        # Get city name for this zip code from markets data, then from retailer data
+        city_name = (market and market['city']) or store_location.get('city')
+        
+        # If still no city found, use zip code as city identifier
+        if not city_name:
+            city_name = f"ZIP {zip_code}"
+            unmatched_zips += 1
+        else:
+            matched_zips += 1
+        
+        # Get state information for this zip code the same way
+        state_name = (market and market['state']) or store_location.get('state')
+        
+        # If still no state found, use empty string
+        if not state_name:
+            state_name = ''
+        
+        # Initialize city data if not exists
+        if city_name not in city_aggregated_data:
+            city_aggregated_data[city_name] = {
+                'retailers': {},
+                'zip_codes': set(),
+                'is_reflex_market': False,
+                'state': state_name
+            }
+        
+        # Aggregate retailers and stores for this city
+        for retailer, count in retailers.items():
+            city_aggregated_data[city_name]['retailers'][retailer] = city_aggregated_data[city_name]['retailers'].get(retailer, 0) + count
+        
+        # Add zip code to city
+        city_aggregated_data[city_name]['zip_codes'].add(zip_code)
+        
+        # Check if this zip code is in market data (reflex market)
+        if market is not None:
+            city_aggregated_data[city_name]['is_reflex_market'] = True
+    
+    logger.info(f"City aggregation: {matched_zips} zip codes matched to cities, {unmatched_zips} unmatched, {len(city_aggregated_data)} total cities")
+    
+    # Build results per city - showing top cities with most stores
+    for city, data in city_aggregated_data.items():
+        # Format retailer list with counts
+        retailer_list = []
+        for retailer, count in sorted(data['retailers'].items()):
+            if count > 1:
+                retailer_list.append(f"{retailer} ({count})")
+            else:
+                retailer_list.append(retailer)
+        
+        # Get top 5 zip codes for this city (for reference)
+        zip_codes_list = sorted(list(data['zip_codes']))[:5]
+        
+        results.append({
+            'City': city,
+            'State': data.get('state', ''),
+            'Prioritized Zip Codes': ', '.join(zip_codes_list),
+            'Retailers': ', '.join(retailer_list),
+            'Total Stores': sum(data['retailers'].values()),
+            'Is Reflex Market': data['is_reflex_market']
+        })
+    
+    # Sort results by total stores (descending) to show top cities with most stores first
+    results.sort(key=lambda x: x['Total Stores'], reverse=True)
+
+    return results
+
+def _join_sorted_groups(keys, values, sep=', '):
+    """Join string values per key, for rows already sorted by key, without a Python call per group."""
+    keys = keys.to_numpy()
+    is_last = np.append(keys[1:] != keys[:-1], True)
+    pieces = values.to_numpy(dtype=object) + np.where(is_last, '', sep).astype(object)
+    return pd.Series(pieces).groupby(keys, sort=False).sum()
+
+def _most_common_by_zip(stores_df, column):
+    """Per ZIP, the non-empty value of column held by most stores, ties to the alphabetically first."""
+    values = stores_df[stores_df[column] != ''].groupby(['zip', column]).size().rename('stores').reset_index()
+    values = values.sort_values(['zip', 'stores', column], ascending=[True, False, True], kind='stable')
+    return values.drop_duplicates('zip')[['zip', column]]
+
+def _run_analysis_pandas(retailer_records, markets_rows):
+    """
+    Vectorized equivalent of _run_analysis using pandas joins and group-bys.
+
+    Produces the same rows in the same order as _run_analysis; it is selected
+    with ANALYSIS_ENGINE=pandas (or engine='pandas') and pays off on large databases.
+    """
+    stores = [store for retailer_entry in retailer_records for store in retailer_entry.get('stores', [])]
+    stores_df = pd.DataFrame({
+        'zip': [store.get('zip_code', '') or '' for store in stores],
+        'name': [store.get('name', '') or '' for store in stores],
+        'city': [store.get('city', '') or '' for store in stores],
+        'state': [store.get('state', '') or '' for store in stores],
+    }, dtype=object)
+    stores_df = stores_df[stores_df['zip'] != '']
+    counted = stores_df[stores_df['name'] != '']
+    if counted.empty:
+        return []
+
+    # Retailer counts per ZIP, ZIPs in sorted order (matches the dict-based engine)
+    counts = counted.groupby(['zip', 'name'], sort=False).size().rename('count').reset_index()
+    zips = pd.DataFrame({'zip': np.sort(pd.unique(counted['zip']))})
+
+    # First market row listing each ZIP
+    market_df = pd.DataFrame([
+        {
+            'zip': zip_code.strip(),
+            'market_city': (row.get('City') or '').strip(),
+            'market_state': (row.get('State') or '').strip(),
+        }
+        for row in markets_rows
+        for zip_code in (row.get('Zip Codes') or row.get('Zip Code') or '').strip().split(',')
+        if zip_code.strip()
+    ], columns=['zip', 'market_city', 'market_state']).drop_duplicates('zip')
+
+    # Most common non-empty city/state among stores in each ZIP (as in the materialized view)
+    store_city = _most_common_by_zip(stores_df, 'city')
+    store_state = _most_common_by_zip(stores_df, 'state')
+
+    zips = (zips.merge(market_df, on='zip', how='left')
+                .merge(store_city, on='zip', how='left')
+                .merge(store_state, on='zip', how='left'))
+    zips['is_market'] = zips['market_city'].notna()
+    zips = zips.fillna('')
+    zips['city_name'] = zips['market_city'].where(zips['market_city'] != '', zips['city'])
+    zips['city_name'] = zips['city_name'].where(zips['city_name'] != '', 'ZIP ' + zips['zip'])
+    zips['state_name'] = zips['market_state'].where(zips['market_state'] != '', zips['state'])
+    zips['city_order'] = pd.factorize(zips['city_name'])[0]
+
+    cities = zips.groupby('city_order', sort=True).agg(
+        City=('city_name', 'first'),
+        State=('state_name', 'first'),
+        is_market=('is_market', 'any'),
+    )
+
+    # Retailer lists: counts per city and store name, sorted by name, "Name (n)" when n > 1
+    per_retailer = counts.merge(zips[['zip', 'city_order']], on='zip')
+    per_retailer = per_retailer.groupby(['city_order', 'name'], sort=False)['count'].sum().reset_index()
+    per_retailer = per_retailer.sort_values(['city_order', 'name'], kind='stable')
+    per_retailer['label'] = per_retailer['name'].where(
+        per_retailer['count'] <= 1, per_retailer['name'] + ' (' + per_retailer['count'].astype(str) + ')')
+    cities['Retailers'] = _join_sorted_groups(per_retailer['city_order'], per_retailer['label'])
+    cities['Total Stores'] = per_retailer.groupby('city_order')['count'].sum()
+
+    # Top 5 ZIP codes per city
+    top_zips = zips.sort_values(['city_order', 'zip'], kind='stable').groupby('city_order').head(5)
+    cities['Prioritized Zip Codes'] = _join_sorted_groups(top_zips['city_order'], top_zips['zip'])
+
+    cities['Is Reflex Market'] = cities['is_market'].astype(bool)
+    cities = cities.sort_values('Total Stores', ascending=False, kind='stable')
+    columns = ['City', 'State', 'Prioritized Zip Codes', 'Retailers', 'Total Stores', 'Is Reflex Market']
+    return [
+        {**row, 'Total Stores': int(row['Total Stores']), 'Is Reflex Market': bool(row['Is Reflex Market'])}
+        for row in cities[columns].to_dict('records')
+    ]
+
+# Default analysis engine: 'python' (dict loops over the materialized view) or 'pandas'
+ANALYSIS_ENGINE = os.getenv('ANALYSIS_ENGINE', 'python')
+
+# Analysis results keyed by (database version, markets version, parameters).
+# Versions change on every write, and writes also clear the cache outright.
+ANALYSIS_CACHE = {}
+ANALYSIS_CACHE_MAX_ENTRIES = 32
+
+def _invalidate_analysis_cache():
+    ANALYSIS_CACHE.clear()
+
+def _resolve_analysis_engine(engine):
+    engine = engine or ANALYSIS_ENGINE
+    return 'pandas' if engine == 'pandas' and pd is not None and np is not None else 'python'
+
+def _analysis_cache_key(markets_rows, params):
+    return (_file_version(DB_FILE), _markets_rows_version(markets_rows), tuple(sorted(params.items())))
+
+def _cache_analysis(key, results):
+    if len(ANALYSIS_CACHE) >= ANALYSIS_CACHE_MAX_ENTRIES:
+        ANALYSIS_CACHE.pop(next(iter(ANALYSIS_CACHE)))
+    ANALYSIS_CACHE[key] = results
+
+def _get_cached_analysis(markets_rows, engine=None, retailers=None):
+    """Return cached analysis results for the current data, or None."""
+    params = {'engine': _resolve_analysis_engine(engine), 'retailers': retailers}
+    return ANALYSIS_CACHE.get(_analysis_cache_key(markets_rows, params))
+
+def _filter_retailer_records(retailer_records, retailers):
+    """Keep only stores whose retailer name or store name is in retailers (lower-cased names)."""
+    filtered = []
+    for retailer_entry in retailer_records:
+        if retailer_entry.get('retailer_name', '').strip().lower() in retailers:
+            filtered.append(retailer_entry)
+            continue
+        stores = [store for store in retailer_entry.get('stores', []) if store.get('name', '').strip().lower() in retailers]
+        if stores:
+            filtered.append({**retailer_entry, 'stores': stores})
+    return filtered
+
+def _get_analysis(markets_rows, retailer_records=None, engine=None, retailers=None):
+    """
+    Return analysis results for the current data, computing them only on a cache miss.
+
+    Args:
+        markets_rows (list): Current markets rows
+        retailer_records (list): Retailer database, loaded on a cache miss when omitted
+        engine (str): 'python' or 'pandas'; defaults to ANALYSIS_ENGINE
+        retailers (tuple): Sorted lower-cased retailer/store names to restrict the analysis to
+    """
+    engine = _resolve_analysis_engine(engine)
+    key = _analysis_cache_key(markets_rows, {'engine': engine, 'retailers': retailers})
+    results = ANALYSIS_CACHE.get(key)
+    if results is not None:
+        logger.info(f"Analyze: Serving {len(results)} cached results")
+        return results
+
+    if engine == 'pandas':
+        if retailer_records is None:
+            retailer_records = _load_db()
+        store_records = _filter_retailer_records(retailer_records, set(retailers)) if retailers else retailer_records
+        results = _run_analysis_pandas(store_records, markets_rows)
+    else:
+        # Reads the materialized view; the database itself is only loaded (or rescanned
+        # when the view is stale) to restrict the analysis to some retailers
+        view = _load_retailer_view(retailer_records)
+        if retailers:
+            if retailer_records is None:
+                retailer_records = _load_db()
+            retailer_by_zip = _count_retailers_by_zip(_filter_retailer_records(retailer_records, set(retailers)))
+        else:
+            retailer_by_zip = view['zips']
+        results = _run_analysis(None, markets_rows, retailer_by_zip=retailer_by_zip,
+                                store_location_index=_get_store_location_index(view))
+    _cache_analysis(key, results)
+    return results
+
+# Coordinates for map markers. Cities resolve from the US postal table (city centroid,
+# else the mean of the row's ZIP centroids); misses fall back to the Google geocoder once
+# and are remembered in GEOCODE_CACHE_FILE.
+GEOCODE_CACHE_FILE = os.path.join(DATA_DIR, 'geocode_cache.json')
+try:
+    GEOCODE_FALLBACK_LIMIT = int(os.getenv('GEOCODE_FALLBACK_LIMIT', '25'))
+except ValueError:
+    GEOCODE_FALLBACK_LIMIT = 25
+
+def _load_geocode_cache():
+    if not os.path.exists(GEOCODE_CACHE_FILE):
+        return {}
+    try:
+        with open(GEOCODE_CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def _save_geocode_cache(cache):
+    _write_json_atomic(GEOCODE_CACHE_FILE, cache)
+
+def _build_centroid_tables():
+    """City and ZIP centroids from the postal table; empty when the data is unavailable."""
+    postal = _get_postal_data()
+    if postal is None:
+        return {'cities': {}, 'zips': {}}
+    geo_df = postal['frame'].dropna(subset=['latitude', 'longitude'])
+    zips = dict(zip(geo_df['zip'], zip(geo_df['latitude'].round(6), geo_df['longitude'].round(6))))
+    grouped = geo_df.groupby(['city_key', 'state_upper'])[['latitude', 'longitude']].mean().round(6)
+    cities = {key: (lat, lng) for key, (lat, lng) in zip(grouped.index, grouped.to_numpy().tolist())}
+    logger.info(f"Built centroid tables: {len(cities)} cities, {len(zips)} ZIP codes")
+    return {'cities': cities, 'zips': zips}
+
+def _get_centroid_tables():
+    return _get_cached_index('centroids', _get_postal_data() is not None, _build_centroid_tables)
+
+def _geocode_fallback(address):
+    """Server-side Google geocode for cities the postal table cannot place; raises on API errors."""
+    results = gmaps.geocode(address)
+    if not results:
+        return None
+    location = results[0]['geometry']['location']
+    return [location['lat'], location['lng']]
+
+def _with_coordinates(rows, zip_field):
+    """
+    Copies of city rows with 'lat'/'lng' attached (None when unresolved).
+
+    Rows may be shared with the analysis cache or session, so they are not modified.
+    """
+    if not rows:
+        return []
+    tables = _get_centroid_tables()
+    geocode_cache = None
+    fallbacks = 0
+    located = []
+    for row in rows:
+        city = (row.get('City') or '').strip()
+        state = (row.get('State') or '').strip().upper()
+        coords = tables['cities'].get((_normalize_city_name(city), state))
+        if coords is None:
+            zip_coords = [tables['zips'][z.strip()] for z in (row.get(zip_field) or '').split(',')
+                          if z.strip() in tables['zips']]
+            if zip_coords:
+                coords = (round(sum(c[0] for c in zip_coords) / len(zip_coords), 6),
+                          round(sum(c[1] for c in zip_coords) / len(zip_coords), 6))
+        if coords is None and city and city != 'Unknown':
+            if geocode_cache is None:
+                geocode_cache = _load_geocode_cache()
+            address = f"{city}, {state}, USA" if state else f"{city}, USA"
+            if address not in geocode_cache and gmaps and fallbacks < GEOCODE_FALLBACK_LIMIT:
+                fallbacks += 1
+                try:
+                    # Misses are cached too, so an unplaceable city is only looked up once
+                    geocode_cache[address] = _geocode_fallback(address)
+                except Exception as e:
+                    logger.warning(f"Geocoding failed for {address}: {e}")
+            coords = geocode_cache.get(address)
+        row = dict(row)
+        row['lat'], row['lng'] = (coords[0], coords[1]) if coords else (None, None)
+        located.append(row)
+    if fallbacks:
+        _save_geocode_cache(geocode_cache)
+    return located
+
+# Spatial trade-area metrics. Points are unit vectors on the sphere, so a straight-line
+# (chord) KD-tree query is exact for great-circle radii; without scipy the same queries
+# run as chunked numpy distance matrices.
+EARTH_RADIUS_MILES = 3958.8
+SPATIAL_RINGS_MILES = (1, 5, 10)
+SPATIAL_MAX_RINGS = 5
+SPATIAL_MAX_RING_MILES = 250
+# Store-pair counting for /api/colocation grows with stores x neighbours, so its radius
+# and the number of stores it will place are capped separately
+COLOCATION_MAX_MILES = 25
+COLOCATION_MAX_STORES = 20000
+
+def _unit_vectors(coords):
+    """(n, 3) unit vectors for a sequence of (lat, lng) degrees."""
+    radians = np.radians(np.asarray(coords, dtype=float).reshape(-1, 2))
+    lat, lng = radians[:, 0], radians[:, 1]
+    return np.column_stack((np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)))
+
+def _miles_to_chord(miles):
+    return 2 * np.sin(np.asarray(miles, dtype=float) / (2 * EARTH_RADIUS_MILES))
+
+def _chord_to_miles(chord):
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.clip(np.asarray(chord, dtype=float) / 2, 0, 1))
+
+def _spatial_query(points, queries, radii_miles=()):
+    """
+    Nearest-point distance and ring counts for every query point.
+
+    Args:
+        points (ndarray): (n, 3) unit vectors to search (n >= 1)
+        queries (ndarray): (m, 3) unit vectors to measure from
+        radii_miles (tuple): Ring radii in miles
+
+    Returns:
+        tuple: (nearest distance in miles per query, [count per query for each radius])
+    """
+    chords = [float(_miles_to_chord(r)) for r in radii_miles]
+    if cKDTree is not None:
+        tree = cKDTree(points)
+        nearest, _ = tree.query(queries, k=1)
+        counts = [np.asarray(tree.query_ball_point(queries, chord, return_length=True)) for chord in chords]
+        return _chord_to_miles(nearest), counts
+
+    nearest = np.empty(len(queries))
+    counts = [np.empty(len(queries), dtype=int) for _ in chords]
+    step = max(1, 2_000_000 // len(points))
+    for start in range(0, len(queries), step):
+        block = queries[start:start + step]
+        # |a - b|^2 = 2 - 2 a.b for unit vectors
+        distances = np.sqrt(np.clip(2 - 2 * block @ points.T, 0, None))
+        nearest[start:start + step] = distances.min(axis=1)
+        for count, chord in zip(counts, chords):
+            count[start:start + step] = (distances <= chord).sum(axis=1)
+    return _chord_to_miles(nearest), counts
+
+def _place_stores(retailer_records, zip_centroids):
+    """Names and (lat, lng) of named stores: their own coordinates, else their ZIP centroid; unplaceable stores are dropped."""
+    store_names, store_coords = [], []
+    for retailer_entry in retailer_records:
+        for store in retailer_entry.get('stores', []):
+            name = store.get('name', '')
+            lat, lng = store.get('latitude') or 0.0, store.get('longitude') or 0.0
+            coords = (lat, lng) if (lat or lng) else zip_centroids.get(store.get('zip_code', ''))
+            if name and coords:
+                store_names.append(name)
+                store_coords.append(coords)
+    return store_names, store_coords
+
+def _count_pairs_within(points_a, points_b, radius_miles, tree_a=None, tree_b=None):
+    """
+    Number of (a, b) point pairs within radius_miles of each other, counted without listing them.
+
+    Callers comparing one point set against many pass its cKDTree as tree_a/tree_b so
+    it is built once; a missing tree is built here.
+    """
+    chord = float(_miles_to_chord(radius_miles))
+    if cKDTree is not None:
+        tree_a = tree_a if tree_a is not None else cKDTree(points_a)
+        tree_b = tree_b if tree_b is not None else cKDTree(points_b)
+        return int(tree_a.count_neighbors(tree_b, chord))
+
+    count = 0
+    step = max(1, 2_000_000 // len(points_b))
+    for start in range(0, len(points_a), step):
+        block = points_a[start:start + step]
+        distances = np.sqrt(np.clip(2 - 2 * block @ points_b.T, 0, None))
+        count += int((distances <= chord).sum())
+    return count
+
+def _run_spatial_analysis(retailer_records, markets_rows, zip_centroids, rings=SPATIAL_RINGS_MILES):
+    """
+    Per market ZIP, count stores within each ring of the ZIP centroid and find the nearest store of each retailer.
+
+    Stores are placed by their own coordinates, else by their ZIP centroid; retailers
+    are identified by store name, as in _run_analysis.
+
+    Args:
+        retailer_records (list): Retailer entries from the database
+        markets_rows (list): Markets rows with City, State and comma-separated Zip Codes
+        zip_centroids (dict): {zip: (lat, lng)}
+        rings (tuple): Ring radii in miles
+
+    Returns:
+        list: One dict per placeable market ZIP (Zip Code, City, State, lat, lng,
+            'Stores within N mi' per ring, Nearest Store (mi) as {retailer: miles})
+    """
+    store_names, store_coords = _place_stores(retailer_records, zip_centroids)
+    market_zips = [(zip_code, market) for zip_code, market in _get_market_zip_index(markets_rows).items()
+                   if zip_code in zip_centroids]
+    if not market_zips:
+        return []
+    zip_coords = [zip_centroids[zip_code] for zip_code, _ in market_zips]
+    queries = _unit_vectors(zip_coords)
+
+    ring_counts = [np.zeros(len(queries), dtype=int) for _ in rings]
+    nearest_by_retailer = {}
+    if store_coords:
+        points = _unit_vectors(store_coords)
+        _, ring_counts = _spatial_query(points, queries, rings)
+        names = np.asarray(store_names, dtype=object)
+        for name in sorted(set(store_names)):
+            nearest_by_retailer[name] = _spatial_query(points[names == name], queries)[0]
+
+    results = []
+    for i, ((zip_code, market), (lat, lng)) in enumerate(zip(market_zips, zip_coords)):
+        row = {'Zip Code': zip_code, 'City': market['city'], 'State': market['state'], 'lat': lat, 'lng': lng}
+        for radius, counts in zip(rings, ring_counts):
+            row[f"Stores within {radius:g} mi"] = int(counts[i])
+        row['Nearest Store (mi)'] = {name: round(float(distances[i]), 2) for name, distances in nearest_by_retailer.items()}
+        results.append(row)
+    return results
+
+def _get_spatial_analysis(markets_rows, rings=SPATIAL_RINGS_MILES, retailers=None):
+    """Spatial analysis for the current data, cached alongside the city analysis."""
+    key = _analysis_cache_key(markets_rows, {'mode': 'spatial', 'rings': rings, 'retailers': retailers})
+    results = ANALYSIS_CACHE.get(key)
+    if results is None:
+        retailer_records = _load_db()
+        if retailers:
+            retailer_records = _filter_retailer_records(retailer_records, set(retailers))
+        results = _run_spatial_analysis(retailer_records, markets_rows, _get_centroid_tables()['zips'], rings)
+        _cache_analysis(key, results)
+    return results
+
+def _run_colocation(retailer_records, zip_centroids=None, within_miles=None, view=None):
+    """
+    Sparse retailer x retailer co-location counts: only pairs that share something are returned.
+
+    Args:
+        retailer_records (list): Retailer entries from the database (retailers are store names)
+        zip_centroids (dict): {zip: (lat, lng)} used to place stores without coordinates
+        within_miles (float): Also count store pairs of the two retailers within this distance
+        view (dict): The materialized view (zips and city rollup) for retailer_records;
+            counted from retailer_records when omitted. Stores are then only read
+            for within_miles.
+
+    Returns:
+        list: One dict per retailer pair (Retailer A < Retailer B) with Shared Zips,
+            Shared Cities, Zip Jaccard and, with within_miles, Store Pairs Within,
+            most shared ZIPs first
+
+    Raises:
+        ValueError: within_miles is set and more than COLOCATION_MAX_STORES stores are placed
+    """
+    if view is None:
+        view = _count_stores(retailer_records)
+    retailers_by_zip, retailers_by_city, zips_by_retailer = {}, {}, {}
+    for zip_code, names in view['zips'].items():
+        retailers_by_zip[zip_code] = set(names)
+        for name in names:
+            zips_by_retailer.setdefault(name, set()).add(zip_code)
+    for state, cities in view['cities'].items():
+        for city, names in cities.items():
+            retailers_by_city.setdefault((city.lower(), state), set()).update(names)
+
+    pairs = {}
+    def add(pair, field, count=1):
+        entry = pairs.setdefault(pair, {'Shared Zips': 0, 'Shared Cities': 0, 'Store Pairs Within': 0})
+        entry[field] += count
+
+    for names in retailers_by_zip.values():
+        for pair in combinations(sorted(names), 2):
+            add(pair, 'Shared Zips')
+    for names in retailers_by_city.values():
+        for pair in combinations(sorted(names), 2):
+            add(pair, 'Shared Cities')
+
+    if within_miles:
+        store_names, store_coords = _place_stores(retailer_records, zip_centroids or {})
+        if len(store_coords) > COLOCATION_MAX_STORES:
+            raise ValueError(f'Too many stores to compare ({len(store_coords)}, limit {COLOCATION_MAX_STORES}); '
+                             f'narrow the request with retailers=')
+        if store_coords:
+            # One point set per retailer; pairs are counted across retailers, never listed
+            points = _unit_vectors(store_coords)
+            names = np.asarray(store_names, dtype=object)
+            points_by_retailer = {name: points[names == name] for name in sorted(set(store_names))}
+            # One KD-tree per retailer, shared by all of its pairs
+            trees = ({name: cKDTree(retailer_points) for name, retailer_points in points_by_retailer.items()}
+                     if cKDTree is not None else {})
+            for a, b in combinations(points_by_retailer, 2):
+                count = _count_pairs_within(points_by_retailer[a], points_by_retailer[b], within_miles,
+                                            trees.get(a), trees.get(b))
+                if count:
+                    add((a, b), 'Store Pairs Within', count)
+
+    results = []
+    for (a, b), entry in pairs.items():
+        zips_a, zips_b = zips_by_retailer.get(a, set()), zips_by_retailer.get(b, set())
+        union = len(zips_a) + len(zips_b) - entry['Shared Zips']
+        row = {'Retailer A': a, 'Retailer B': b, 'Shared Zips': entry['Shared Zips'],
+               'Shared Cities': entry['Shared Cities'],
+               'Zip Jaccard': round(entry['Shared Zips'] / union, 4) if union else 0.0}
+        if within_miles:
+            row['Store Pairs Within'] = entry['Store Pairs Within']
+        results.append(row)
+    results.sort(key=lambda row: (-row['Shared Zips'], -row['Shared Cities'], row['Retailer A'], row['Retailer B']))
+    return results
+
+def _get_colocation(within_miles=None, retailers=None):
+    """Co-location pairs for the current retailer database, cached per database version."""
+    key = (_file_version(DB_FILE), 'colocation', within_miles, retailers)
+    results = ANALYSIS_CACHE.get(key)
+    if results is None:
+        # Shared ZIPs and cities for all retailers come from the materialized view;
+        # stores are only loaded for a retailer subset or for distances
+        view = None if retailers else _load_retailer_view()
+        retailer_records = _load_db() if retailers or within_miles else []
+        if retailers:
+            retailer_records = _filter_retailer_records(retailer_records, set(retailers))
+        zip_centroids = _get_centroid_tables()['zips'] if within_miles else None
+        results = _run_colocation(retailer_records, zip_centroids, within_miles, view=view)
+        _cache_analysis(key, results)
+    return results
 
-@app.route('/clear-markets', methods=['POST'])
-def clear_markets():
-    """Clear all markets data from session and persistent storage."""
-    try:
-        # Clear from session
-        session.pop('markets_rows', None)
-        
-        # Clear from persistent storage
-        persistent_file = 'data/markets_database.json'
-        if os.path.exists(persistent_file):
-            with open(persistent_file, 'w') as f:
-                json.dump([], f)
-        
-        logger.info("Cleared all markets data from session and persistent storage")
-        return jsonify({'success': True, 'message': 'All markets data cleared successfully'})
-    
-    except Exception as e:
-        logger.error(f"Error clearing markets data: {e}")
-        return jsonify({'success': False, 'error': str(e)})
+def _build_zip_bitmaps(retailer_records, markets_rows):
+    """
+    ZIP membership bitmaps: bit i of each Python int is set when zips[i] has the retailer or is in the market.
 
-def _extract_zip_from_address(address: str) -> str:
-    if not address:
-        return ''
-    m = re.search(r"\b(\d{5})(?:-\d{4})?\b", address)
-    return m.group(1) if m else ''
+    Returns:
+        dict: zips (sorted list), retailers {lower-cased store name: bitmap},
+            markets {"City, ST": bitmap}, market_zips (bitmap of every market ZIP)
+            and locations {zip: (city, state)}
+    """
+    market_index = _get_market_zip_index(markets_rows)
+    store_location_index = _build_store_location_index(retailer_records)
+    zips = sorted(set(market_index) | set(store_location_index))
+    position = {zip_code: i for i, zip_code in enumerate(zips)}
+
+    retailers = {}
+    for retailer_entry in retailer_records:
+        for store in retailer_entry.get('stores', []):
+            name = store.get('name', '').strip().lower()
+            if name and store.get('zip_code'):
+                retailers[name] = retailers.get(name, 0) | (1 << position[store['zip_code']])
+
+    markets = {}
+    market_zips = 0
+    locations = {}
+    for zip_code, location in store_location_index.items():
+        locations[zip_code] = (location.get('city', ''), location.get('state', ''))
+    for zip_code, market in market_index.items():
+        bit = 1 << position[zip_code]
+        label = f"{market['city']}, {market['state']}".strip(', ')
+        markets[label] = markets.get(label, 0) | bit
+        market_zips |= bit
+        locations[zip_code] = (market['city'], market['state'])
+    return {'zips': zips, 'retailers': retailers, 'markets': markets,
+            'market_zips': market_zips, 'locations': locations}
+
+def _get_zip_bitmaps(markets_rows):
+    version = (_file_version(DB_FILE), _markets_rows_version(markets_rows))
+    return _get_cached_index('zip_bitmaps', version, lambda: _build_zip_bitmaps(_load_db(), markets_rows))
+
+def _query_zip_bitmaps(bitmaps, all_of=(), any_of=(), none_of=(), markets=None):
+    """
+    ZIPs matching a boolean query over retailers, as a bitmap.
+
+    Args:
+        bitmaps (dict): _build_zip_bitmaps output
+        all_of, any_of, none_of: Lower-cased store names the ZIP must have all of,
+            at least one of, and none of
+        markets: "City, ST" labels to search within; every market ZIP when None,
+            every known ZIP when empty
+    """
+    if markets is None:
+        result = bitmaps['market_zips']
+    elif markets:
+        result = 0
+        for label in markets:
+            result |= bitmaps['markets'].get(label, 0)
+    else:
+        result = (1 << len(bitmaps['zips'])) - 1
+    retailers = bitmaps['retailers']
+    for name in all_of:
+        result &= retailers.get(name, 0)
+    if any_of:
+        matches_any = 0
+        for name in any_of:
+            matches_any |= retailers.get(name, 0)
+        result &= matches_any
+    for name in none_of:
+        result &= ~retailers.get(name, 0)
+    return result
+
+def _bitmap_positions(bitmap):
+    """Indices of the set bits, lowest first."""
+    positions = []
+    while bitmap:
+        lowest = bitmap & -bitmap
+        positions.append(lowest.bit_length() - 1)
+        bitmap ^= lowest
+    return positions
+
+def _get_markets_rows():
+    """Current markets rows: the session copy if present, else the latest persisted upload."""
+    markets_rows = session.get('markets_rows', [])
+    if not markets_rows:
+        markets_db = _load_markets_db()
+        if markets_db:
+            markets_rows = markets_db[-1]['data']  # Get most recent upload
+    return markets_rows
 
 @app.route('/analyze', methods=['GET', 'POST'])
 def analyze():
     results = []
-    if request.method == 'POST':
-        logger.info("Analyze: POST request received")
-        # Try to get markets data from session first, then fall back to file-based storage
-        markets_rows = session.get('markets_rows', [])
-        if not markets_rows:
-            # Load from persistent file-based database (get most recent entry)
-            markets_db = _load_markets_db()
-            if markets_db:
-                markets_rows = markets_db[-1]['data']  # Get most recent upload
-                logger.info(f"Analyze: Loaded {len(markets_rows)} ZIP entries from persistent database")
-            else:
-                logger.info("Analyze: No Live Markets data found in session or persistent database")
-        
+    if request.method == 'GET':
+        # Show the last analysis if the data has not changed since it ran
+        markets_rows = _get_markets_rows()
+        if markets_rows:
+            results = _get_cached_analysis(markets_rows) or []
+        return render_template('analyze.html', results=_with_coordinates(results, 'Prioritized Zip Codes'), api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
+
+    logger.info("Analyze: POST request received")
+    markets_rows = _get_markets_rows()
+    if not markets_rows:
+        logger.info("Analyze: No Live Markets data found in session or persistent database")
+        flash('No Live Markets data found. Please upload a CSV file in the Live Markets section first.', 'warning')
+        return render_template('analyze.html', results=_with_coordinates(results, 'Prioritized Zip Codes'), api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
+
+    cached = _get_cached_analysis(markets_rows)
+    if cached is not None:
+        results = cached
+    else:
         retailer_records = _load_db()
         logger.info(f"Analyze: Using {len(markets_rows)} List Market Zip Codes entries and {len(retailer_records)} retailer records")
         
-        if not markets_rows:
-            flash('No Live Markets data found. Please upload a CSV file in the Live Markets section first.', 'warning')
-            return render_template('analyze.html', results=results, api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
-        
         if not retailer_records:
             flash('No retailer data found. Please add retailers to the database first.', 'warning')
-            return render_template('analyze.html', results=results, api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
-
-        # Map retailer locations by ZIP -> dict of retailer names and their counts
-        retailer_by_zip = {}
-        processed_retailers = 0
-        skipped_retailers = 0
-        
-        for retailer_entry in retailer_records:
-            # Handle new structure: retailer_entry has 'stores' array
-            if 'stores' in retailer_entry:
-                stores = retailer_entry.get('stores', [])
-                for store in stores:
-                    name = store.get('name', '')
-                    address = store.get('formatted_address') or store.get('address', '')
-                    z = _extract_zip_from_address(address)
-                    
-                    if not z or not name:
-                        skipped_retailers += 1
-                        logger.debug(f"Skipped store: name='{name}', address='{address}', zip='{z}'")
-                        continue
-                    
-                    if z not in retailer_by_zip:
-                        retailer_by_zip[z] = {}
-                    retailer_by_zip[z][name] = retailer_by_zip[z].get(name, 0) + 1
-                    processed_retailers += 1
-            else:
-                # Handle old structure: individual store records
-                name = retailer_entry.get('name') or retailer_entry.get('google_store', {}).get('name', '')
-                address = retailer_entry.get('formatted_address') or retailer_entry.get('address') or retailer_entry.get('google_store', {}).get('formatted_address', '')
-                z = _extract_zip_from_address(address)
-                
-                if not z or not name:
-                    skipped_retailers += 1
-                    logger.debug(f"Skipped retailer: name='{name}', address='{address}', zip='{z}'")
-                    continue
-                
-                if z not in retailer_by_zip:
-                    retailer_by_zip[z] = {}
-                retailer_by_zip[z][name] = retailer_by_zip[z].get(name, 0) + 1
-                processed_retailers += 1
-        
-        logger.info(f"Retailer processing: {processed_retailers} processed, {skipped_retailers} skipped, {len(retailer_by_zip)} unique zip codes")
-
-        # Create a set of all market zip codes for reflex market checking
-        all_market_zips = set()
-        for row in markets_rows:
-            zip_codes_str = (row.get('Zip Codes') or row.get('Zip Code') or '').strip()
-            if zip_codes_str:
-                zip_codes = [z.strip() for z in zip_codes_str.split(',') if z.strip()]
-                all_market_zips.update(zip_codes)
-        
-        # Group retailer locations by city -> aggregate all retailers and stores per city
-        city_aggregated_data = {}
-        matched_zips = 0
-        unmatched_zips = 0
-        
-        for zip_code, retailers in retailer_by_zip.items():
-            # Get city name for this zip code from markets data or use zip code as fallback
-            city_name = None
-            for row in markets_rows:
-                zip_codes_str = (row.get('Zip Codes') or row.get('Zip Code') or '').strip()
-                if zip_codes_str:
-                    zip_codes = [z.strip() for z in zip_codes_str.split(',') if z.strip()]
-                    if zip_code in zip_codes:
-                        city_name = (row.get('City') or '').strip()
-                        break
-            
-            # If no city found in markets data, try to get city name from retailer data
-            if not city_name:
-                # Look through retailer data to find a city name for this zip code
-                for retailer_entry in retailer_records:
-                    if 'stores' in retailer_entry:
-                        stores = retailer_entry.get('stores', [])
-                        for store in stores:
-                            store_zip = _extract_zip_from_address(store.get('formatted_address') or store.get('address', ''))
-                            if store_zip == zip_code and store.get('city'):
-                                city_name = store.get('city', '').strip()
-                                break
-                        if city_name:
-                            break
-                    else:
-                        # Handle old structure
-                        store_zip = _extract_zip_from_address(retailer_entry.get('formatted_address') or retailer_entry.get('address', ''))
-                        if store_zip == zip_code and retailer_entry.get('city'):
-                            city_name = retailer_entry.get('city', '').strip()
-                            break
-            
-            # If still no city found, use zip code as city identifier
-            if not city_name:
-                city_name = f"ZIP {zip_code}"
-                unmatched_zips += 1
-            else:
-                matched_zips += 1
-            
-            # Get state information for this zip code
-            state_name = None
-            for row in markets_rows:
-                zip_codes_str = (row.get('Zip Codes') or row.get('Zip Code') or '').strip()
-                if zip_codes_str:
-                    zip_codes = [z.strip() for z in zip_codes_str.split(',') if z.strip()]
-                    if zip_code in zip_codes:
-                        state_name = (row.get('State') or '').strip()
-                        break
-            
-            # If no state found in markets data, try to get from retailer data
-            if not state_name:
-                for retailer_entry in retailer_records:
-                    if 'stores' in retailer_entry:
-                        stores = retailer_entry.get('stores', [])
-                        for store in stores:
-                            store_zip = _extract_zip_from_address(store.get('formatted_address') or store.get('address', ''))
-                            if store_zip == zip_code and store.get('state'):
-                                state_name = store.get('state', '').strip()
-                                break
-                        if state_name:
-                            break
-                    else:
-                        # Handle old structure
-                        store_zip = _extract_zip_from_address(retailer_entry.get('formatted_address') or retailer_entry.get('address', ''))
-                        if store_zip == zip_code and retailer_entry.get('state'):
-                            state_name = retailer_entry.get('state', '').strip()
-                            break
-            
-            # If still no state found, use empty string
-            if not state_name:
-                state_name = ''
-            
-            # Initialize city data if not exists
-            if city_name not in city_aggregated_data:
-                city_aggregated_data[city_name] = {
-                    'retailers': {},
-                    'zip_codes': set(),
-                    'is_reflex_market': False,
-                    'state': state_name
-                }
-            
-            # Aggregate retailers and stores for this city
-            for retailer, count in retailers.items():
-                city_aggregated_data[city_name]['retailers'][retailer] = city_aggregated_data[city_name]['retailers'].get(retailer, 0) + count
-            
-            # Add zip code to city
-            city_aggregated_data[city_name]['zip_codes'].add(zip_code)
-            
-            # Check if this zip code is in market data (reflex market)
-            if zip_code in all_market_zips:
-                city_aggregated_data[city_name]['is_reflex_market'] = True
-        
-        logger.info(f"City aggregation: {matched_zips} zip codes matched to cities, {unmatched_zips} unmatched, {len(city_aggregated_data)} total cities")
-        
-        # Build results per city - showing top cities with most stores
-        for city, data in city_aggregated_data.items():
-            # Format retailer list with counts
-            retailer_list = []
-            for retailer, count in sorted(data['retailers'].items()):
-                if count > 1:
-                    retailer_list.append(f"{retailer} ({count})")
-                else:
-                    retailer_list.append(retailer)
-            
-            # Get top 5 zip codes for this city (for reference)
-            zip_codes_list = sorted(list(data['zip_codes']))[:5]
-            
-            results.append({
-                'City': city,
-                'State': data.get('state', ''),
-                'Prioritized Zip Codes': ', '.join(zip_codes_list),
-                'Retailers': ', '.join(retailer_list),
-                'Total Stores': sum(data['retailers'].values()),
-                'Is Reflex Market': data['is_reflex_market']
-            })
-        
-        # Sort results by total stores (descending) to show top cities with most stores first
-        results.sort(key=lambda x: x['Total Stores'], reverse=True)
+            return render_template('analyze.html', results=_with_coordinates(results, 'Prioritized Zip Codes'), api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
+
+        results = _get_analysis(markets_rows, retailer_records)
         
-        flash(f'Analysis completed! Found {len(results)} cities with retailer data.', 'success')
-        logger.info(f"Analyze: Completed analysis with {len(results)} results")
+    flash(f'Analysis completed! Found {len(results)} cities with retailer data.', 'success')
+    logger.info(f"Analyze: Completed analysis with {len(results)} results")
+
+    return render_template('analyze.html', results=_with_coordinates(results, 'Prioritized Zip Codes'), api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
+
+# Sort keys accepted by /api/analysis, mapped to result fields
+ANALYSIS_SORT_KEYS = {
+    'total_stores': lambda row: row['Total Stores'],
+    'city': lambda row: row['City'].lower(),
+    'state': lambda row: row['State'],
+    'retailer_count': lambda row: len(row['Retailers'].split(', ')) if row['Retailers'] else 0,
+}
+ANALYSIS_PAGE_SIZE = 50
+ANALYSIS_MAX_PAGE_SIZE = 500
+
+def _encode_cursor(offset, data_version, query_hash):
+    payload = json.dumps({'o': offset, 'v': data_version, 'q': query_hash}).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+def _decode_cursor(cursor):
+    """Return (offset, data_version, query_hash) from a cursor; raises ValueError if it is malformed."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        offset = int(payload['o'])
+        version, query_hash = payload['v'], payload['q']
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if offset < 0:
+        raise ValueError('Invalid cursor')
+    return offset, version, query_hash
+
+@app.route('/api/analysis', methods=['GET'])
+def api_analysis():
+    """
+    JSON view of the analysis results with filtering, sorting and cursor pagination.
+
+    Query parameters:
+        retailers: comma-separated retailer or store names to analyze (default: all)
+        states: comma-separated state codes to keep
+        min_stores: minimum Total Stores per city
+        reflex: 'true'/'false' to keep only market / non-market cities
+        sort: one of ANALYSIS_SORT_KEYS, prefixed with '-' for descending (default: -total_stores)
+        limit: page size (default 50, max 500)
+        cursor: next_cursor from the previous page
+    """
+    try:
+        markets_rows = _get_markets_rows()
+        if not markets_rows:
+            return jsonify({'error': 'No Live Markets data found. Upload a markets CSV first.'}), 400
+
+        retailers = tuple(sorted({r.strip().lower() for r in request.args.get('retailers', '').split(',') if r.strip()})) or None
+        states = {s.strip().upper() for s in request.args.get('states', '').split(',') if s.strip()}
+        reflex = request.args.get('reflex', '').strip().lower()
+        sort = request.args.get('sort', '-total_stores').strip()
+        sort_key = sort.lstrip('-')
+        if sort_key not in ANALYSIS_SORT_KEYS:
+            return jsonify({'error': f"sort must be one of: {', '.join(ANALYSIS_SORT_KEYS)}"}), 400
+        try:
+            min_stores = int(request.args.get('min_stores', 0))
+            limit = min(max(int(request.args.get('limit', ANALYSIS_PAGE_SIZE)), 1), ANALYSIS_MAX_PAGE_SIZE)
+        except ValueError:
+            return jsonify({'error': 'min_stores and limit must be integers'}), 400
+
+        results = _get_analysis(markets_rows, retailers=retailers)
+        data_version = hashlib.sha1(repr(_analysis_cache_key(markets_rows, {'retailers': retailers})).encode('utf-8')).hexdigest()[:16]
+        # Offsets only make sense for the filters and sort they were issued under
+        query_hash = hashlib.sha1(repr((retailers, sorted(states), min_stores, reflex, sort)).encode('utf-8')).hexdigest()[:16]
+
+        offset = 0
+        cursor = request.args.get('cursor')
+        if cursor:
+            offset, cursor_version, cursor_query = _decode_cursor(cursor)
+            if cursor_query != query_hash:
+                return jsonify({'error': 'Cursor was issued for different filters or sort; restart from the first page'}), 400
+            if cursor_version != data_version:
+                return jsonify({'error': 'Data changed since this cursor was issued; restart from the first page'}), 409
+
+        rows = [
+            row for row in results
+            if (not states or row['State'].upper() in states)
+            and row['Total Stores'] >= min_stores
+            and (reflex not in ('true', 'false') or row['Is Reflex Market'] == (reflex == 'true'))
+        ]
+        # Results are already ordered by Total Stores descending
+        if sort != '-total_stores':
+            rows = sorted(rows, key=ANALYSIS_SORT_KEYS[sort_key], reverse=sort.startswith('-'))
+
+        page = rows[offset:offset + limit]
+        next_offset = offset + len(page)
+        return jsonify({
+            'success': True,
+            'total': len(rows),
+            'count': len(page),
+            'results': page,
+            'next_cursor': _encode_cursor(next_offset, data_version, query_hash) if next_offset < len(rows) else None,
+            'data_version': data_version
+        })
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in analysis API: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/spatial-analysis', methods=['GET'])
+def api_spatial_analysis():
+    """
+    Trade-area metrics per market ZIP: store counts within rings and nearest store per retailer.
+
+    Query parameters:
+        rings: comma-separated ring radii in miles (default 1,5,10)
+        retailers: comma-separated retailer or store names to include (default: all)
+    """
+    try:
+        if np is None:
+            return jsonify({'error': 'Spatial analysis requires numpy'}), 500
+        markets_rows = _get_markets_rows()
+        if not markets_rows:
+            return jsonify({'error': 'No Live Markets data found. Upload a markets CSV first.'}), 400
+
+        try:
+            rings = tuple(sorted({float(r) for r in request.args.get('rings', '').split(',') if r.strip()})) or SPATIAL_RINGS_MILES
+        except ValueError:
+            return jsonify({'error': 'rings must be numbers of miles'}), 400
+        if len(rings) > SPATIAL_MAX_RINGS or not all(0 < r <= SPATIAL_MAX_RING_MILES for r in rings):
+            return jsonify({'error': f'Up to {SPATIAL_MAX_RINGS} rings between 0 and {SPATIAL_MAX_RING_MILES} miles'}), 400
+        retailers = tuple(sorted({r.strip().lower() for r in request.args.get('retailers', '').split(',') if r.strip()})) or None
+
+        results = _get_spatial_analysis(markets_rows, rings=rings, retailers=retailers)
+        return jsonify({
+            'success': True,
+            'rings': list(rings),
+            'market_zips': len(_get_market_zip_index(markets_rows)),
+            'count': len(results),
+            'results': results
+        })
+
+    except Exception as e:
+        logger.error(f"Error in spatial analysis API: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/colocation', methods=['GET'])
+def api_colocation():
+    """
+    Retailer x retailer co-location: shared ZIPs and cities per retailer pair.
+
+    Query parameters:
+        within_miles: also count store pairs of the two retailers within this many miles
+        retailers: comma-separated retailer or store names to include (default: all)
+        min_shared: minimum Shared Zips or Shared Cities for a pair to be listed
+        format: 'json' (default) or 'csv'
+    """
+    try:
+        try:
+            within_miles = float(request.args['within_miles']) if request.args.get('within_miles') else None
+            min_shared = int(request.args.get('min_shared', 0))
+        except ValueError:
+            return jsonify({'error': 'within_miles must be a number and min_shared an integer'}), 400
+        if within_miles is not None and not 0 < within_miles <= COLOCATION_MAX_MILES:
+            return jsonify({'error': f'within_miles must be between 0 and {COLOCATION_MAX_MILES}'}), 400
+        if within_miles is not None and np is None:
+            return jsonify({'error': 'within_miles requires numpy'}), 500
+        retailers = tuple(sorted({r.strip().lower() for r in request.args.get('retailers', '').split(',') if r.strip()})) or None
+
+        results = [
+            row for row in _get_colocation(within_miles=within_miles, retailers=retailers)
+            if max(row['Shared Zips'], row['Shared Cities']) >= min_shared
+        ]
+
+        if request.args.get('format', 'json').lower() == 'csv':
+            fields = ['Retailer A', 'Retailer B', 'Shared Zips', 'Shared Cities', 'Zip Jaccard']
+            if within_miles is not None:
+                fields.append('Store Pairs Within')
+            output = io.StringIO()
+            writer = csv.DictWriter(output, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(results)
+            return Response(output.getvalue(), mimetype='text/csv',
+                            headers={'Content-Disposition': 'attachment; filename=retailer_colocation.csv'})
+
+        return jsonify({
+            'success': True,
+            'within_miles': within_miles,
+            'count': len(results),
+            'results': results
+        })
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in co-location API: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/whitespace', methods=['GET'])
+def api_whitespace():
+    """
+    ZIPs matching a boolean retailer query, e.g. market ZIPs with Tecovas but no PacSun.
 
-    return render_template('analyze.html', results=results, api_key=os.getenv('GOOGLE_MAPS_API_KEY') or '')
+    Query parameters:
+        all: comma-separated store names every matching ZIP must have
+        any: comma-separated store names of which a matching ZIP must have at least one
+        none: comma-separated store names a matching ZIP must not have
+        market: "City, ST" to search within (repeatable); default every market ZIP
+        scope: 'all' to search every known ZIP instead of market ZIPs
+    """
+    try:
+        markets_rows = _get_markets_rows()
+        bitmaps = _get_zip_bitmaps(markets_rows)
+
+        def names(param):
+            return [n.strip().lower() for n in request.args.get(param, '').split(',') if n.strip()]
+        all_of, any_of, none_of = names('all'), names('any'), names('none')
+        markets = request.args.getlist('market') or (None if request.args.get('scope') != 'all' else [])
+
+        matches = _query_zip_bitmaps(bitmaps, all_of, any_of, none_of, markets)
+        results = []
+        for i in _bitmap_positions(matches):
+            zip_code = bitmaps['zips'][i]
+            city, state = bitmaps['locations'].get(zip_code, ('', ''))
+            results.append({'Zip Code': zip_code, 'City': city, 'State': state})
+
+        return jsonify({
+            'success': True,
+            'count': len(results),
+            'cities': sorted({f"{row['City']}, {row['State']}".strip(', ') for row in results if row['City']}),
+            'unknown_retailers': sorted({n for n in all_of + any_of + none_of if n not in bitmaps['retailers']}),
+            'unknown_markets': sorted(set(markets or []) - set(bitmaps['markets'])),
+            'results': results
+        })
+
+    except Exception as e:
+        logger.error(f"Error in whitespace API: {e}")
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/api/zip-cache', methods=['GET'])
 def get_zip_cache():
@@ -1068,6 +2953,61 @@ def get_zip_cache():
         'has_data': len(markets_rows) > 0
     })
 
+@app.route('/api/cities', methods=['GET'])
+def suggest_cities():
+    """Typeahead for the city picker: ?q=<name prefix>[, ST]&limit=N."""
+    query = request.args.get('q', '').strip()
+    state = request.args.get('state', '').strip().upper() or None
+    if ',' in query:
+        query, state = query.split(',', 1)
+        state = state.strip().upper() or None
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), CITY_SUGGEST_LIMIT)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    if not query.strip():
+        return jsonify({'cities': []})
+    try:
+        matches = _suggest_cities(_get_city_prefix_index(), query, state, limit)
+    except Exception as e:
+        logger.error(f"Error in city suggestions: {e}")
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'cities': [{'city': name, 'state': place_state, 'label': f"{name}, {place_state}", 'zip_count': zip_count}
+                               for name, place_state, zip_count in matches]})
+
+def _build_store_lookup_index(retailer_records):
+    """
+    Index stores by ZIP and by (city, state) for /api/store-details.
+
+    Entries are (position, store) pairs; position is the store's order in the
+    database so lookups can return matches in the same order as a full scan.
+    """
+    by_zip = {}
+    by_city = {}
+    position = 0
+    for retailer_entry in retailer_records:
+        for store in retailer_entry.get('stores', []):
+            entry = (position, store)
+            if store.get('zip_code'):
+                by_zip.setdefault(store['zip_code'], []).append(entry)
+            by_city.setdefault((store.get('city', '').lower(), store.get('state', '').lower()), []).append(entry)
+            position += 1
+    return {'by_zip': by_zip, 'by_city': by_city}
+
+def _get_store_lookup_index():
+    return _get_cached_index('store_lookup', _file_version(DB_FILE),
+                             lambda: _build_store_lookup_index(_load_db()))
+
+def _lookup_stores(index, zip_list, city, state):
+    """Stores in any of zip_list or in city/state, each once, in database order. O(number of matches)."""
+    matches = {}
+    for zip_code in zip_list:
+        for position, store in index['by_zip'].get(zip_code, []):
+            matches[position] = store
+    for position, store in index['by_city'].get((city.lower(), state.lower()), []):
+        matches[position] = store
+    return [matches[position] for position in sorted(matches)]
+
 @app.route('/api/store-details', methods=['POST'])
 def get_store_details():
     """API endpoint to get detailed store information for a specific city/state."""
@@ -1080,35 +3020,11 @@ def get_store_details():
         
         logger.info(f"Store details request for: {city}, {state}")
         
-        # Load retailer data
-        retailer_records = _load_db()
-        matching_stores = []
-        
         # Parse zip codes
         zip_list = [z.strip() for z in zip_codes.split(',') if z.strip()]
         
-        # Find stores matching the criteria
-        for retailer_entry in retailer_records:
-            if 'stores' in retailer_entry:
-                stores = retailer_entry.get('stores', [])
-                for store in stores:
-                    store_zip = _extract_zip_from_address(store.get('formatted_address') or store.get('address', ''))
-                    store_city = store.get('city', '').strip()
-                    store_state = store.get('state', '').strip()
-                    
-                    # Check if store matches the criteria
-                    if (store_zip in zip_list or 
-                        (store_city.lower() == city.lower() and store_state.lower() == state.lower())):
-                        matching_stores.append(store)
-            else:
-                # Handle old structure
-                store_zip = _extract_zip_from_address(retailer_entry.get('formatted_address') or retailer_entry.get('address', ''))
-                store_city = retailer_entry.get('city', '').strip()
-                store_state = retailer_entry.get('state', '').strip()
-                
-                if (store_zip in zip_list or 
-                    (store_city.lower() == city.lower() and store_state.lower() == state.lower())):
-                    matching_stores.append(retailer_entry)
+        # Find stores in any of the zip codes or in the city/state via the per-version index
+        matching_stores = _lookup_stores(_get_store_lookup_index(), zip_list, city, state)
         
         logger.info(f"Found {len(matching_stores)} matching stores")
         
@@ -1129,11 +3045,12 @@ def get_store_details():
 def get_markets_database():
     """API endpoint to get all persistent markets/zip data."""
     try:
-        markets_db = _load_markets_db()
+        # History view: archived uploads followed by the current one
+        markets_history = _load_markets_history()
         return jsonify({
             'success': True,
-            'total_uploads': len(markets_db),
-            'uploads': markets_db
+            'total_uploads': len(markets_history),
+            'uploads': markets_history
         })
     except Exception as e:
         logger.error(f"Error getting markets database: {e}")
@@ -1143,20 +3060,30 @@ def get_markets_database():
 def delete_markets_upload(upload_index):
     """API endpoint to delete a specific markets upload."""
     try:
+        # Indexes follow the history order returned by get_markets_database
+        markets_archive = _load_markets_archive_expanded()
         markets_db = _load_markets_db()
         
-        if upload_index < 0 or upload_index >= len(markets_db):
+        if upload_index < 0 or upload_index >= len(markets_archive) + len(markets_db):
             return jsonify({'success': False, 'error': 'Invalid upload index'})
         
-        deleted_upload = markets_db.pop(upload_index)
-        _save_markets_db(markets_db)
+        if upload_index < len(markets_archive):
+            deleted_upload = markets_archive.pop(upload_index)
+            _save_markets_archive_compact(markets_archive)
+        else:
+            deleted_upload = markets_db.pop(upload_index - len(markets_archive))
+            if not markets_db and markets_archive:
+                # Previous upload becomes current again
+                markets_db.append(markets_archive.pop())
+                _save_markets_archive_compact(markets_archive)
+            _save_markets_db(markets_db)
         
         logger.info(f"Deleted markets upload: {deleted_upload.get('filename', 'Unknown')}")
         
         return jsonify({
             'success': True,
             'message': f'Successfully deleted upload: {deleted_upload.get("filename", "Unknown")}',
-            'remaining_uploads': len(markets_db)
+            'remaining_uploads': len(markets_archive) + len(markets_db)
         })
         
     except Exception as e:
@@ -1168,6 +3095,7 @@ def clear_markets_database():
     """API endpoint to clear all markets/zip data."""
     try:
         _save_markets_db([])
+        _save_markets_archive([])
         logger.info("Markets database cleared")
         return jsonify({'success': True, 'message': 'Markets database cleared successfully'})
     except Exception as e:
@@ -1589,13 +3517,14 @@ def save_to_database():
         if not retailer_name or not stores:
             return jsonify({'success': False, 'error': 'Missing retailer name or stores data'})
         
-        # Filter out permanently closed stores
+        # Normalize location/status fields once here so read paths never re-parse addresses,
+        # then filter out permanently closed stores
         active_stores = []
         closed_count = 0
         
         for store in stores:
-            business_status = store.get('business_status', '').lower()
-            if business_status in ['permanently_closed', 'closed_permanently']:
+            store = _normalize_store(store)
+            if store['business_status'] == 'CLOSED_PERMANENTLY':
                 closed_count += 1
                 continue
             active_stores.append(store)
@@ -1611,17 +3540,66 @@ def save_to_database():
         retailer_data = _load_db()
         logger.info(f"Loaded {len(retailer_data)} existing retailers from database")
         
+        # Identical payload (e.g. a double-clicked save): nothing to write
+        content_hash = _stores_content_hash(retailer_name, active_stores)
+        if any(r.get('content_hash') == content_hash and not r.get('removed', False) for r in retailer_data):
+            logger.info(f"Skipped duplicate save for retailer '{retailer_name}'")
+            return jsonify({
+                'success': True,
+                'duplicate': True,
+                'message': f'{retailer_name} is already saved with these {len(active_stores)} stores',
+                'total_retailers': len(retailer_data),
+                'active_stores': len(active_stores),
+                'closed_stores_excluded': closed_count,
+                'unique_cities': len(unique_cities)
+            })
+        
+        # Same retailer saved before: merge new stores by place_id instead of adding a second entry
+        existing = next((r for r in retailer_data
+                         if not r.get('removed', False) and r.get('retailer_name', '').strip().lower() == retailer_name.strip().lower()), None)
+        if existing is not None:
+            added = _merge_stores(existing.setdefault('stores', []), active_stores)
+            if not added:
+                # Every store is already saved: leave the database and caches untouched
+                logger.info(f"No new stores to merge into existing retailer '{retailer_name}'")
+                return jsonify({
+                    'success': True,
+                    'merged': True,
+                    'message': f'No new stores for {retailer_name} ({len(existing["stores"])} already saved)',
+                    'total_retailers': len(retailer_data),
+                    'active_stores': len(existing['stores']),
+                    'closed_stores_excluded': closed_count,
+                    'unique_cities': _count_cities(existing['stores'])
+                })
+            existing['total_stores'] = len(existing['stores'])
+            existing['total_cities'] = _count_cities(existing['stores'])
+            existing['content_hash'] = _stores_content_hash(existing['retailer_name'], existing['stores'])
+            existing['date_updated'] = datetime.now().isoformat()
+            _save_db_incremental(retailer_data, added_stores=added)
+            logger.info(f"Merged {len(added)} new stores into existing retailer '{retailer_name}'")
+            return jsonify({
+                'success': True,
+                'merged': True,
+                'message': f'Added {len(added)} new stores to {retailer_name} ({existing["total_stores"]} total)',
+                'total_retailers': len(retailer_data),
+                'active_stores': existing['total_stores'],
+                'closed_stores_excluded': closed_count,
+                'unique_cities': existing['total_cities']
+            })
+        
         # Add the new retailer data
         retailer_entry = {
             'retailer_name': retailer_name,
             'stores': active_stores,
             'total_stores': len(active_stores),
             'total_cities': len(unique_cities),
-            'date_added': datetime.now().isoformat()
+            'date_added': datetime.now().isoformat(),
+            'content_hash': content_hash,
+            'retailer_id': uuid.uuid4().hex
         }
         
         retailer_data.append(retailer_entry)
-        _save_db(retailer_data)
+        _save_db_incremental(retailer_data, added_stores=active_stores)
         
         message = f'Successfully saved {len(active_stores)} active stores for {retailer_name}'
         if closed_count > 0:
@@ -1649,42 +3627,81 @@ def clear_database():
     """Clear the retailer database (for testing purposes)."""
     try:
         _save_db([])
+        _save_retailer_archive([])
         logger.info("Retailer database cleared")
         return jsonify({'success': True, 'message': 'Database cleared successfully'})
     except Exception as e:
         logger.error(f"Error clearing database: {e}")
         return jsonify({'success': False, 'error': str(e)})
 
+def _find_retailer(data, retailer_data, archive):
+    """
+    Locate the retailer a remove/restore/delete request refers to.
+
+    Requests identify retailers by retailer_id; retailer_index (position in the
+    retailer database page, active retailers followed by archived ones) is
+    accepted for older clients.
+
+    Returns:
+        tuple: (list containing the retailer, index in that list), or (None, None)
+    """
+    retailer_id = data.get('retailer_id')
+    if retailer_id:
+        for records in (retailer_data, archive):
+            for i, retailer in enumerate(records):
+                if retailer.get('retailer_id') == retailer_id:
+                    return records, i
+        return None, None
+
+    # JSON clients may send the index as a string ("3")
+    try:
+        retailer_index = int(data.get('retailer_index'))
+    except (TypeError, ValueError):
+        return None, None
+    if retailer_index < 0:
+        return None, None
+    if retailer_index < len(retailer_data):
+        return retailer_data, retailer_index
+    if retailer_index < len(retailer_data) + len(archive):
+        return archive, retailer_index - len(retailer_data)
+    return None, None
+
 @app.route('/remove-retailer', methods=['POST'])
 def remove_retailer():
-    """Remove a retailer from the database (mark as removed but keep data)."""
+    """Remove a retailer from the database (move it to the archive but keep its data)."""
     try:
         data = request.get_json()
-        retailer_index = data.get('retailer_index')
         
-        if retailer_index is None:
+        if data.get('retailer_id') is None and data.get('retailer_index') is None:
             return jsonify({'success': False, 'error': 'Missing retailer index'})
         
         # Load existing database
         retailer_data = _load_db()
+        archive = _load_retailer_archive()
         
-        if retailer_index < 0 or retailer_index >= len(retailer_data):
+        records, index = _find_retailer(data, retailer_data, archive)
+        if records is None:
             return jsonify({'success': False, 'error': 'Invalid retailer index'})
         
-        # Mark retailer as removed
-        retailer_data[retailer_index]['removed'] = True
-        retailer_data[retailer_index]['removed_date'] = datetime.now().isoformat()
-        
-        # Save updated database
-        _save_db(retailer_data)
+        retailer = records[index]
+        if records is retailer_data:
+            # Mark retailer as removed and move it to the archive
+            retailer_data.pop(index)
+            retailer['removed'] = True
+            retailer['removed_date'] = datetime.now().isoformat()
+            archive.append(retailer)
+            
+            # Archive first so a failed second write cannot lose the retailer
+            _save_retailer_archive(archive)
+            _save_db_incremental(retailer_data, removed_stores=retailer.get('stores', []))
         
-        retailer_name = retailer_data[retailer_index].get('retailer_name', 'Unknown')
+        retailer_name = retailer.get('retailer_name', 'Unknown')
         logger.info(f"Removed retailer '{retailer_name}' from database")
         
         return jsonify({
             'success': True,
             'message': f'Successfully removed {retailer_name}',
-            'remaining_retailers': len([r for r in retailer_data if not r.get('removed', False)])
+            'remaining_retailers': len(retailer_data)
         })
         
     except Exception as e:
@@ -1693,35 +3710,40 @@ def remove_retailer():
 
 @app.route('/restore-retailer', methods=['POST'])
 def restore_retailer():
-    """Restore a removed retailer to the database."""
+    """Restore a removed retailer from the archive to the database."""
     try:
         data = request.get_json()
-        retailer_index = data.get('retailer_index')
         
-        if retailer_index is None:
+        if data.get('retailer_id') is None and data.get('retailer_index') is None:
             return jsonify({'success': False, 'error': 'Missing retailer index'})
         
         # Load existing database
         retailer_data = _load_db()
+        archive = _load_retailer_archive()
         
-        if retailer_index < 0 or retailer_index >= len(retailer_data):
+        records, index = _find_retailer(data, retailer_data, archive)
+        if records is None:
             return jsonify({'success': False, 'error': 'Invalid retailer index'})
         
-        # Restore retailer
-        retailer_data[retailer_index]['removed'] = False
-        if 'removed_date' in retailer_data[retailer_index]:
-            del retailer_data[retailer_index]['removed_date']
-        
-        # Save updated database
-        _save_db(retailer_data)
+        retailer = records[index]
+        if records is archive:
+            # Restore retailer
+            archive.pop(index)
+            retailer['removed'] = False
+            retailer.pop('removed_date', None)
+            retailer_data.append(retailer)
+            
+            # Database first so a failed second write cannot lose the retailer
+            _save_db_incremental(retailer_data, added_stores=retailer.get('stores', []))
+            _save_retailer_archive(archive)
         
-        retailer_name = retailer_data[retailer_index].get('retailer_name', 'Unknown')
+        retailer_name = retailer.get('retailer_name', 'Unknown')
         logger.info(f"Restored retailer '{retailer_name}' to database")
         
         return jsonify({
             'success': True,
             'message': f'Successfully restored {retailer_name}',
-            'remaining_retailers': len([r for r in retailer_data if not r.get('removed', False)])
+            'remaining_retailers': len(retailer_data)
         })
         
     except Exception as e:
@@ -1730,28 +3752,30 @@ def restore_retailer():
 
 @app.route('/delete-retailer', methods=['POST'])
 def delete_retailer():
-    """Permanently delete a retailer from the database."""
+    """Permanently delete a retailer from the database or the archive."""
     try:
         data = request.get_json()
-        retailer_index = data.get('retailer_index')
         
-        if retailer_index is None:
+        if data.get('retailer_id') is None and data.get('retailer_index') is None:
             return jsonify({'success': False, 'error': 'Missing retailer index'})
         
         # Load existing database
         retailer_data = _load_db()
+        archive = _load_retailer_archive()
         
-        if retailer_index < 0 or retailer_index >= len(retailer_data):
+        records, index = _find_retailer(data, retailer_data, archive)
+        if records is None:
             return jsonify({'success': False, 'error': 'Invalid retailer index'})
         
-        # Get retailer name for logging
-        retailer_name = retailer_data[retailer_index].get('retailer_name', 'Unknown')
-        
         # Permanently remove the retailer
-        deleted_retailer = retailer_data.pop(retailer_index)
+        deleted_retailer = records.pop(index)
+        retailer_name = deleted_retailer.get('retailer_name', 'Unknown')
         
         # Save updated database
-        _save_db(retailer_data)
+        if records is retailer_data:
+            _save_db_incremental(retailer_data, removed_stores=deleted_retailer.get('stores', []))
+        else:
+            _save_retailer_archive(archive)
         
         logger.info(f"Permanently deleted retailer '{retailer_name}' with {deleted_retailer.get('total_stores', 0)} stores")
         
@@ -1845,112 +3869,174 @@ def upload_results_csv():
         logger.error(f"Error uploading results CSV: {e}")
         return jsonify({'success': False, 'error': str(e)})
 
+# Set BULK_UPLOAD_WORKERS > 1 to parse bulk-uploaded CSVs in a process pool
+try:
+    BULK_UPLOAD_WORKERS = int(os.getenv('BULK_UPLOAD_WORKERS', '0'))
+except ValueError:
+    BULK_UPLOAD_WORKERS = 0
+
+def _csv_column(df, names, default=''):
+    """Return the first column of df found in names, or a constant Series of default."""
+    for name in names:
+        if name in df.columns:
+            return df[name]
+    return pd.Series(default, index=df.index)
+
+def _parse_retailer_csv(stream, filename):
+    """
+    Parse one bulk-upload CSV into a retailer entry without iterating rows.
+
+    Runs in a worker process when BULK_UPLOAD_WORKERS > 1, so it only takes
+    and returns plain picklable values.
+
+    Args:
+        stream: Binary file-like object with the upload (read once, hashed as it is parsed)
+        filename (str): Secure filename, used to derive the retailer name
+
+    Returns:
+        dict: Retailer entry ready to be appended to the database
+
+    Raises:
+        ValueError: If the file has no rows or no store name/address columns
+    """
+    # Keep ZIP codes as strings so leading zeros survive
+    reader = _HashingReader(stream)
+    df = pd.read_csv(reader, dtype={'ZIP': str, 'Zip': str})
+    if df.empty:
+        raise ValueError('CSV file has no rows')
+    if not any(col in df.columns for col in ('Store Name', 'Name', 'Address')):
+        raise ValueError('CSV file needs a "Store Name", "Name" or "Address" column')
+
+    def text(names):
+        return _csv_column(df, names).fillna('').astype(str).str.strip()
+
+    def number(names):
+        return pd.to_numeric(_csv_column(df, names, 0), errors='coerce').fillna(0).astype(float)
+
+    retailer_name = filename.replace('.csv', '').replace('_', ' ').title()
+    address = text(['Address'])
+    stores_df = pd.DataFrame({
+        'name': text(['Store Name', 'Name']),
+        'address': address,
+        'city': text(['City']),
+        'state': text(['State']),
+        'zip_code': text(['ZIP', 'Zip']),
+        'phone_number': text(['Phone']),
+        'rating': number(['Rating']),
+        'website': text(['Website']),
+        'latitude': number(['Latitude']),
+        'longitude': number(['Longitude']),
+        'formatted_address': address,
+        'business_status': 'OPERATIONAL',
+        'retailer_name': retailer_name,
+    })
+    stores = [_normalize_store(store) for store in stores_df.to_dict('records')]
+
+    return {
+        'retailer_name': retailer_name,
+        'stores': stores,
+        'total_stores': len(stores),
+        'total_cities': _count_cities(stores),
+        'date_added': datetime.now().isoformat(),
+        'source': 'csv_upload',
+        'filename': filename,
+        'source_hash': reader.hexdigest(),
+        'content_hash': _stores_content_hash(retailer_name, stores),
+        'retailer_id': uuid.uuid4().hex,
+        'removed': False
+    }
+
 @app.route('/bulk-upload-retailers', methods=['POST'])
 def bulk_upload_retailers():
-    """Handle bulk CSV upload for retailer database."""
+    """Handle bulk CSV upload for retailer database.
+
+    All files are parsed and validated first; the new retailer entries are then
+    committed to the database in a single write. Each file gets its own result.
+    """
     try:
         files = request.files.getlist('csv_files')
         
         if not files or all(file.filename == '' for file in files):
             return jsonify({'success': False, 'error': 'No files selected'})
         
-        uploaded_files = []
+        # One result per submitted file, in upload order
+        uploaded_files = [None] * len(files)
+        saved_files = []
         
-        for file in files:
+        for position, file in enumerate(files):
             if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                
-                try:
-                    # Read CSV file
-                    df = pd.read_csv(filepath)
-                    
-                    # Process the CSV data (similar to existing CSV upload logic)
-                    stores = []
-                    for _, row in df.iterrows():
-                        # Extract store information from CSV
-                        store = {
-                            'name': str(row.get('Store Name', row.get('Name', ''))),
-                            'address': str(row.get('Address', '')),
-                            'city': str(row.get('City', '')),
-                            'state': str(row.get('State', '')),
-                            'zip_code': str(row.get('ZIP', row.get('Zip', ''))),
-                            'phone_number': str(row.get('Phone', '')),
-                            'rating': float(row.get('Rating', 0)) if row.get('Rating') else 0,
-                            'website': str(row.get('Website', '')),
-                            'latitude': float(row.get('Latitude', 0)) if row.get('Latitude') else 0,
-                            'longitude': float(row.get('Longitude', 0)) if row.get('Longitude') else 0,
-                            'formatted_address': str(row.get('Address', '')),
-                            'business_status': 'OPERATIONAL',
-                            'retailer_name': filename.replace('.csv', '').replace('_', ' ').title()
-                        }
-                        stores.append(store)
-                    
-                    # Filter out permanently closed stores
-                    active_stores = []
-                    closed_count = 0
-                    
-                    for store in stores:
-                        business_status = store.get('business_status', '').lower()
-                        if business_status in ['permanently_closed', 'closed_permanently']:
-                            closed_count += 1
-                            continue
-                        active_stores.append(store)
-                    
-                    # Count unique cities
-                    unique_cities = set()
-                    for store in active_stores:
-                        city = store.get('city', '').strip()
-                        if city:
-                            unique_cities.add(city)
-                    
-                    # Create retailer entry
-                    retailer_entry = {
-                        'retailer_name': store['retailer_name'],
-                        'stores': active_stores,
-                        'total_stores': len(active_stores),
-                        'total_cities': len(unique_cities),
-                        'date_added': datetime.now().isoformat(),
-                        'source': 'csv_upload',
-                        'filename': filename,
-                        'removed': False
-                    }
-                    
-                    # Save to database
-                    all_retailer_data = _load_db()
-                    all_retailer_data.append(retailer_entry)
-                    _save_db(all_retailer_data)
-                    
-                    uploaded_files.append({
-                        'filename': filename,
-                        'upload_date': datetime.now().isoformat(),
-                        'status': 'success',
-                        'stores_count': len(stores),
-                        'retailer_name': store['retailer_name']
-                    })
-                    
-                    logger.info(f"Successfully processed CSV file: {filename} with {len(stores)} stores")
-                    
-                except Exception as e:
-                    logger.error(f"Error processing CSV file {filename}: {e}")
-                    uploaded_files.append({
-                        'filename': filename,
-                        'upload_date': datetime.now().isoformat(),
-                        'status': 'error',
-                        'error': str(e)
-                    })
-                finally:
-                    # Clean up uploaded file
-                    if os.path.exists(filepath):
-                        os.remove(filepath)
+                # Parsed straight from the request's upload stream; nothing is written to uploads/
+                saved_files.append((position, file.stream, secure_filename(file.filename)))
             else:
-                uploaded_files.append({
+                uploaded_files[position] = {
                     'filename': file.filename if file else 'unknown',
                     'upload_date': datetime.now().isoformat(),
                     'status': 'error',
                     'error': 'Invalid file type or empty file'
-                })
+                }
+
+        # Parse every file before touching the database
+        if BULK_UPLOAD_WORKERS > 1 and len(saved_files) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=min(BULK_UPLOAD_WORKERS, len(saved_files))) as pool:
+                # Worker processes get a picklable in-memory copy of each upload
+                futures = [pool.submit(_parse_retailer_csv, io.BytesIO(stream.read()), name) for _, stream, name in saved_files]
+                parsed = []
+                for future in futures:
+                    try:
+                        parsed.append((future.result(), None))
+                    except Exception as e:
+                        parsed.append((None, e))
+        else:
+            parsed = []
+            for _, stream, name in saved_files:
+                try:
+                    parsed.append((_parse_retailer_csv(stream, name), None))
+                except Exception as e:
+                    parsed.append((None, e))
+
+        # Hashes already in the database; re-uploaded files and repeated store sets are skipped
+        new_entries = []
+        all_retailer_data = _load_db() if saved_files else []
+        seen_hashes = {r.get('source_hash') for r in all_retailer_data} | {r.get('content_hash') for r in all_retailer_data}
+        seen_hashes.discard(None)
+        for (position, _, filename), (retailer_entry, error) in zip(saved_files, parsed):
+            if error is None and (retailer_entry['source_hash'] in seen_hashes or retailer_entry['content_hash'] in seen_hashes):
+                uploaded_files[position] = {
+                    'filename': filename,
+                    'upload_date': datetime.now().isoformat(),
+                    'status': 'skipped',
+                    'reason': 'duplicate',
+                    'retailer_name': retailer_entry['retailer_name']
+                }
+                logger.info(f"Skipped duplicate CSV file: {filename}")
+                continue
+            if error is not None:
+                logger.error(f"Error processing CSV file {filename}: {error}")
+                uploaded_files[position] = {
+                    'filename': filename,
+                    'upload_date': datetime.now().isoformat(),
+                    'status': 'error',
+                    'error': str(error)
+                }
+                continue
+
+            new_entries.append(retailer_entry)
+            seen_hashes.update((retailer_entry['source_hash'], retailer_entry['content_hash']))
+            uploaded_files[position] = {
+                'filename': filename,
+                'upload_date': datetime.now().isoformat(),
+                'status': 'success',
+                'stores_count': retailer_entry['total_stores'],
+                'retailer_name': retailer_entry['retailer_name']
+            }
+            logger.info(f"Successfully processed CSV file: {filename} with {retailer_entry['total_stores']} stores")
+
+        # Commit all new retailers in one write
+        if new_entries:
+            all_retailer_data.extend(new_entries)
+            _save_db_incremental(all_retailer_data, added_stores=[store for entry in new_entries for store in entry['stores']])
+            logger.info(f"Bulk upload saved {len(new_entries)} retailers in a single write")
         
         return jsonify({
             'success': True,
@@ -1962,6 +4048,77 @@ def bulk_upload_retailers():
         logger.error(f"Error in bulk upload: {e}")
         return jsonify({'success': False, 'error': str(e)})
 
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Apply pending retailer database migrations (run on deploy)."""
+    version = _run_migrations()
+    print(f"Retailer database is at schema version {version}")
+
+@app.cli.command('build-city-index')
+def build_city_index_command():
+    """Rebuild the offline city -> ZIP index used by market uploads."""
+    index = _build_city_zip_index()
+    _write_json_atomic(CITY_ZIP_INDEX_FILE, index)
+    print(f"Indexed {sum(len(cities) for cities in index.values())} cities in {len(index)} states")
+
+@app.cli.command('build-city-state-table')
+def build_city_state_table_command():
+    """Rebuild the city -> state ranking used for market entries without a state."""
+    _get_city_zip_index()
+    table = _build_city_state_table()
+    index_version = list(_file_version(CITY_ZIP_INDEX_FILE) or []) or None
+    _write_json_atomic(CITY_STATE_TABLE_FILE, {'city_index_version': index_version, 'cities': table})
+    ambiguous = sum(1 for states in table.values() if len(states) > 1)
+    print(f"Ranked states for {len(table)} cities ({ambiguous} in more than one state)")
+
+@app.cli.command('build-postal-table')
+@click.option('--source', type=click.Choice(['zipcodes', 'pgeocode']), default='zipcodes',
+              help="zipcodes (pip install zipcodes; the bundled table's source) or pgeocode's "
+                   "GeoNames dataset (needs network on first run)")
+def build_postal_table_command(source):
+    """Rebuild the bundled postal table."""
+    geo_df = _zipcodes_postal_frame() if source == 'zipcodes' else pgeocode.Nominatim('us')._data
+    table = _build_postal_table(geo_df)
+    np.save(POSTAL_TABLE_FILE, table)
+    print(f"Wrote {len(table)} postal codes ({os.path.getsize(POSTAL_TABLE_FILE) // 1024} KB) to {POSTAL_TABLE_FILE}")
+
+@app.cli.command('compact-db')
+def compact_db_command():
+    """Collapse duplicate retailer entries left by repeated saves and uploads."""
+    retailer_data = _load_db()
+    compacted, merged = _compact_retailer_data(retailer_data)
+    if merged:
+        _save_db(compacted)
+    print(f"Merged {merged} duplicate retailer entries; {len(compacted)} remain")
+
+def prepare_app():
+    """
+    One-time startup work for a serving process: migrate the retailer database, archive
+    superseded markets uploads, purge expired sessions and load the postal data.
+
+    Called by the server entry points (index.py, passenger_wsgi.py and __main__) rather
+    than at import, so tests, benchmarks and CLI commands leave data/ untouched. A failed
+    migration raises: request handlers assume the current schema, so the app must not
+    start on unmigrated data.
+    """
+    version = _run_migrations()
+    logger.info(f"Retailer database is at schema version {version}")
+
+    try:
+        _archive_superseded_markets()
+    except Exception as e:
+        logger.error(f"Error archiving markets uploads: {e}")
+
+    try:
+        _purge_expired_sessions()
+    except Exception as e:
+        logger.error(f"Error purging expired sessions: {e}")
+
+    try:
+        warm_postal_data()
+    except Exception as e:
+        logger.error(f"Error loading postal data: {e}")
+
 if __name__ == '__main__':
     # Check if API key is configured
     if not os.getenv('GOOGLE_MAPS_API_KEY'):
@@ -1974,5 +4131,6 @@ if __name__ == '__main__':
     except ValueError:
         port = 5002
 
+    prepare_app()
     app.run(debug=True, host='0.0.0.0', port=port)
 
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Benchmark the dict-based and pandas analysis engines on a synthetic database.
+
+Usage: python bench_analysis.py [num_stores ...]   (default: 10000 100000 250000)
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import _run_analysis, _run_analysis_pandas
+from test_analysis import make_sample_data
+
+
+def time_call(func, *args, repeat=3):
+    """Best wall-clock time of func(*args) over repeat runs, plus its result."""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 250000]
+    print(f"{'stores':>10} {'python (s)':>12} {'pandas (s)':>12} {'rows':>8}")
+    for num_stores in sizes:
+        retailer_records, markets_rows = make_sample_data(num_stores, num_zips=max(400, num_stores // 10),
+                                                          num_cities=num_stores // 100)
+        python_time, expected = time_call(_run_analysis, retailer_records, markets_rows)
+        pandas_time, actual = time_call(_run_analysis_pandas, retailer_records, markets_rows)
+        status = '' if actual == expected else '  MISMATCH'
+        print(f"{num_stores:>10} {python_time:>12.3f} {pandas_time:>12.3f} {len(expected):>8}{status}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Benchmark /api/store-details lookups: indexed lookup vs. a full scan as the database grows.
+
+Usage: python bench_store_details.py [num_stores ...]   (default: 1000 10000 100000 250000)
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import _build_store_lookup_index, _lookup_stores
+from test_analysis import make_sample_data
+
+
+def scan_stores(retailer_records, zip_list, city, state):
+    """The pre-index implementation: check every store on every request."""
+    matching_stores = []
+    for retailer_entry in retailer_records:
+        for store in retailer_entry.get('stores', []):
+            if (store.get('zip_code') in zip_list or
+                    (store.get('city', '').lower() == city.lower() and store.get('state', '').lower() == state.lower())):
+                matching_stores.append(store)
+    return matching_stores
+
+
+def time_lookups(func, queries, *args):
+    """Average milliseconds per query."""
+    start = time.perf_counter()
+    for zip_list, city, state in queries:
+        func(*args, zip_list, city, state)
+    return (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000, 250000]
+    print(f"{'stores':>10} {'scan (ms)':>10} {'index (ms)':>11} {'matches':>8}")
+    for num_stores in sizes:
+        # Keep cities at ~50 stores each so the result size stays constant as the DB grows
+        retailer_records, _ = make_sample_data(num_stores, num_zips=max(400, num_stores // 5),
+                                               num_cities=num_stores // 50)
+        index = _build_store_lookup_index(retailer_records)
+        stores = [store for entry in retailer_records for store in entry['stores']]
+        queries = [([store['zip_code']], f'Town {i}', 'TX') for i, store in enumerate(stores[:50])]
+
+        scan_ms = time_lookups(scan_stores, queries[:5], retailer_records)
+        index_ms = time_lookups(_lookup_stores, queries, index)
+        matches = sum(len(_lookup_stores(index, *query)) for query in queries) // len(queries)
+        print(f"{num_stores:>10} {scan_ms:>10.3f} {index_ms:>11.4f} {matches:>8}")
+
+
+if __name__ == '__main__':
+    main()
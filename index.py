@@ -16,7 +16,8 @@ os.chdir(current_dir)
 
 try:
     # Import the Flask app
-    from app import app
+    from app import app, prepare_app
+    prepare_app()
     
     # For GoDaddy, we need to expose the application
     application = app
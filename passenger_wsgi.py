@@ -11,7 +11,8 @@ import os
 sys.path.insert(0, os.path.dirname(__file__))
 
 # Import the Flask app
-from app import app
+from app import app, prepare_app
+prepare_app()
 
 # Passenger expects 'application'
 application = app
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Analysis engine tests: the pandas engine must match the dict-based engine, and the
+spatial analysis must give the same answer with and without scipy's KD-tree. Also
+covers the store normalization and the offline city lookups every analysis relies on.
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app
+from app import _run_analysis, _run_analysis_pandas, _run_spatial_analysis, _run_colocation
+from app import _build_zip_bitmaps, _query_zip_bitmaps, _bitmap_positions
+from app import _build_retailer_view, _patch_retailer_view, _store_locations_from_counts
+from app import _encode_markets_rows, _decode_markets_rows
+from app import _normalize_store, _normalize_state, _migrate_v2_normalize_stores
+from app import _resolve_city_zips, _get_city_state_table, _rank_city_states
+from app import _fuzzy_match_city, _get_city_trigram_index, _suggest_cities, _get_city_prefix_index
+
+
+def make_sample_data(num_stores, num_zips=400, num_cities=0, seed=7):
+    """Build retailer entries and markets rows with the awkward cases the engines must agree on:
+    ZIPs outside any market, stores missing city/state/name, city names shared across states,
+    and ZIPs listed in more than one market row."""
+    rng = random.Random(seed)
+    zips = [f"{rng.randint(1000, 99999):05d}" for _ in range(num_zips)]
+    cities = [('Springfield', 'IL'), ('Springfield', 'MO'), ('Austin', 'TX'), ('Dallas', 'TX'),
+              ('Portland', 'OR'), ('Portland', 'ME'), ('Miami', 'FL'), ('Boston', 'MA')]
+    cities += [(f'Town {i}', rng.choice(['TX', 'CA', 'NY', 'FL'])) for i in range(num_cities)]
+    names = ['Tecovas', 'PacSun', 'Aritzia', 'Alo Yoga', 'Warby Parker', 'Vuori']
+
+    retailer_records = []
+    for retailer_index in range(max(1, num_stores // 250)):
+        stores = []
+        for _ in range(min(250, num_stores - retailer_index * 250)):
+            city, state = rng.choice(cities)
+            stores.append({
+                'name': rng.choice(names + ['']),
+                'zip_code': rng.choice(zips + ['']),
+                'city': city if rng.random() > 0.2 else '',
+                'state': state if rng.random() > 0.2 else '',
+            })
+        retailer_records.append({'retailer_name': f'Retailer {retailer_index}', 'stores': stores})
+
+    markets_rows = []
+    for city, state in cities[:5]:
+        market_zips = rng.sample(zips, 20)
+        markets_rows.append({'City': city if rng.random() > 0.1 else '', 'State': state,
+                             'Zip Codes': ', '.join(market_zips)})
+    return retailer_records, markets_rows
+
+
+@contextmanager
+def offline_city_indexes():
+    """Build the city indexes from the bundled postal table into a temporary directory."""
+    data_dir = tempfile.mkdtemp()
+    saved = {name: getattr(app, name) for name in ('CITY_ZIP_INDEX_FILE', 'CITY_STATE_TABLE_FILE')}
+    try:
+        app.CITY_ZIP_INDEX_FILE = os.path.join(data_dir, 'city_zip_index.json')
+        app.CITY_STATE_TABLE_FILE = os.path.join(data_dir, 'city_state_table.json')
+        yield data_dir
+    finally:
+        for name, value in saved.items():
+            setattr(app, name, value)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def test_pandas_engine_matches_python_engine():
+    """Both engines return identical rows in identical order."""
+    for seed in range(5):
+        retailer_records, markets_rows = make_sample_data(3000, seed=seed)
+        expected = _run_analysis(retailer_records, markets_rows)
+        actual = _run_analysis_pandas(retailer_records, markets_rows)
+        assert actual == expected, f"Engines disagree for seed {seed}"
+
+
+def test_engines_handle_empty_data():
+    """No stores means no result rows for either engine."""
+    assert _run_analysis([], []) == []
+    assert _run_analysis_pandas([], []) == []
+    assert _run_analysis_pandas([{'retailer_name': 'X', 'stores': [{'name': '', 'zip_code': ''}]}], []) == []
+
+
+def test_patched_view_matches_rebuilt_view():
+    """Removing and re-adding stores incrementally gives the same view (ZIP counts, locations and
+    city rollup) and the same analysis as a rebuild."""
+    retailer_records, markets_rows = make_sample_data(3000, seed=3)
+    view = _build_retailer_view(retailer_records)
+    for entry in retailer_records[:3]:
+        _patch_retailer_view(view, removed_stores=entry['stores'])
+    for entry in reversed(retailer_records[:3]):
+        _patch_retailer_view(view, added_stores=entry['stores'])
+
+    rebuilt = _build_retailer_view(retailer_records)
+    for field in ('zips', 'locations', 'cities'):
+        assert json.dumps(view[field]) == json.dumps(rebuilt[field]), f"{field} differs after patching"
+
+    # Analysis and co-location read only the view, never the stores
+    expected = _run_analysis(retailer_records, markets_rows)
+    assert _run_analysis(None, markets_rows, retailer_by_zip=view['zips'],
+                         store_location_index=_store_locations_from_counts(view['locations'])) == expected
+    assert _run_colocation([], view=view) == _run_colocation(retailer_records)
+
+
+def test_markets_history_deltas_round_trip():
+    """Archived uploads decode back to the exact rows, and reordered uploads are still stored as deltas."""
+    rng = random.Random(11)
+    base = [{'City': f'City {i}', 'State': rng.choice(['TX', 'CA', 'NY']), 'Zip Codes': f'{10000 + i:05d}'}
+            for i in range(200)]
+    base.append(dict(base[0]))  # repeated row
+    uploads = [base]
+    for _ in range(6):
+        rows = [row for row in uploads[-1] if rng.random() > 0.05]
+        rows += [{'City': f'New {rng.random():.6f}', 'State': 'FL', 'Zip Codes': '33101'} for _ in range(5)]
+        if rng.random() > 0.4:
+            rng.shuffle(rows)
+        uploads.append(rows)
+
+    for rows, next_rows in zip(uploads, uploads[1:]):
+        delta = _encode_markets_rows(rows, next_rows)
+        assert _decode_markets_rows(next_rows, delta) == rows
+        # Only rows missing from the next upload are stored in full
+        missing = Counter(tuple(row.items()) for row in rows) - Counter(tuple(row.items()) for row in next_rows)
+        assert len(delta['added']) == sum(missing.values())
+    assert _decode_markets_rows(base, _encode_markets_rows(base, base)) == base
+    assert _encode_markets_rows(base, base) == {'added': [], 'dropped': []}
+
+
+def test_spatial_analysis_rings_and_nearest():
+    """Ring counts and nearest distances agree between the KD-tree and numpy paths."""
+    zip_centroids = {'10001': (40.7506, -73.9972), '10003': (40.7317, -73.9892), '11201': (40.6940, -73.9903)}
+    retailer_records = [{'retailer_name': 'A', 'stores': [
+        {'name': 'Tecovas', 'zip_code': '10001', 'latitude': 40.7506, 'longitude': -73.9972},
+        {'name': 'Tecovas', 'zip_code': '10003', 'latitude': 0.0, 'longitude': 0.0},  # placed at its ZIP centroid
+        {'name': 'PacSun', 'zip_code': '', 'latitude': 40.6940, 'longitude': -73.9903},
+        {'name': 'PacSun', 'zip_code': '99999', 'latitude': 0.0, 'longitude': 0.0},  # cannot be placed
+    ]}]
+    markets_rows = [{'City': 'New York', 'State': 'NY', 'Zip Codes': '10001, 10003, 11201, 00000'}]
+
+    results = _run_spatial_analysis(retailer_records, markets_rows, zip_centroids, rings=(1, 5))
+    assert [row['Zip Code'] for row in results] == ['10001', '10003', '11201']
+    by_zip = {row['Zip Code']: row for row in results}
+    assert by_zip['10001']['Stores within 1 mi'] == 1
+    assert by_zip['10001']['Stores within 5 mi'] == 3
+    assert by_zip['10001']['Nearest Store (mi)']['Tecovas'] == 0.0
+    assert 3.9 < by_zip['10001']['Nearest Store (mi)']['PacSun'] < 4.2
+
+    kdtree = app.cKDTree
+    try:
+        app.cKDTree = None
+        assert _run_spatial_analysis(retailer_records, markets_rows, zip_centroids, rings=(1, 5)) == results
+    finally:
+        app.cKDTree = kdtree
+
+
+def test_colocation_counts_shared_zips_cities_and_nearby_stores():
+    """Only retailer pairs that share something are listed, each once, with the KD-tree and numpy paths agreeing."""
+    zip_centroids = {'10001': (40.7506, -73.9972), '10003': (40.7317, -73.9892), '90210': (34.0901, -118.4065)}
+    stores = [
+        ('Tecovas', '10001', 'New York', 'NY'), ('PacSun', '10001', 'New York', 'NY'),
+        ('Tecovas', '10003', 'New York', 'NY'), ('Aritzia', '10003', 'New York', 'NY'),
+        ('Vuori', '90210', 'Beverly Hills', 'CA'),
+    ]
+    retailer_records = [{'retailer_name': 'All', 'stores': [
+        {'name': name, 'zip_code': zip_code, 'city': city, 'state': state, 'latitude': 0.0, 'longitude': 0.0}
+        for name, zip_code, city, state in stores
+    ]}]
+
+    results = _run_colocation(retailer_records, zip_centroids, within_miles=2)
+    by_pair = {(row['Retailer A'], row['Retailer B']): row for row in results}
+    assert set(by_pair) == {('PacSun', 'Tecovas'), ('Aritzia', 'Tecovas'), ('Aritzia', 'PacSun')}
+    assert by_pair[('PacSun', 'Tecovas')]['Shared Zips'] == 1
+    assert by_pair[('PacSun', 'Tecovas')]['Shared Cities'] == 1
+    assert by_pair[('PacSun', 'Tecovas')]['Zip Jaccard'] == 0.5
+    assert by_pair[('PacSun', 'Tecovas')]['Store Pairs Within'] == 2
+    assert by_pair[('Aritzia', 'PacSun')]['Shared Zips'] == 0
+
+    kdtree = app.cKDTree
+    try:
+        app.cKDTree = None
+        assert _run_colocation(retailer_records, zip_centroids, within_miles=2) == results
+    finally:
+        app.cKDTree = kdtree
+
+
+def test_zip_bitmap_queries_match_set_logic():
+    """all/any/none bitmap queries over market ZIPs give the same ZIPs as the equivalent set expression."""
+    retailer_records, markets_rows = make_sample_data(3000, seed=3)
+    bitmaps = _build_zip_bitmaps(retailer_records, markets_rows)
+    market_zips = {z.strip() for row in markets_rows for z in row['Zip Codes'].split(',')}
+    zips_of = {}
+    for store in (store for entry in retailer_records for store in entry['stores']):
+        if store['name'] and store['zip_code']:
+            zips_of.setdefault(store['name'].lower(), set()).add(store['zip_code'])
+
+    matches = _query_zip_bitmaps(bitmaps, all_of=['tecovas'], any_of=['aritzia', 'vuori'], none_of=['pacsun'])
+    expected = market_zips & zips_of['tecovas'] & (zips_of['aritzia'] | zips_of['vuori']) - zips_of['pacsun']
+    assert expected and {bitmaps['zips'][i] for i in _bitmap_positions(matches)} == expected
+    assert _query_zip_bitmaps(bitmaps, all_of=['nobody']) == 0
+
+
+def test_normalize_store_location_and_status_fields():
+    """ZIPs are zero-padded and cut to ZIP5, state names become codes, and statuses map onto STORE_STATUSES."""
+    store = _normalize_store({'name': ' Tecovas ', 'zip_code': '7030', 'state': 'New  Jersey',
+                              'latitude': '40.74', 'longitude': None, 'business_status': 'temporarily_closed'})
+    assert store['name'] == 'Tecovas'
+    assert store['zip_code'] == '07030'
+    assert store['state'] == 'NJ'
+    assert (store['latitude'], store['longitude']) == (40.74, 0.0)
+    assert store['business_status'] == 'CLOSED_TEMPORARILY'
+
+    assert _normalize_store({'zip_code': 2134.0})['zip_code'] == '02134'
+    assert _normalize_store({'zip_code': '02134-1234'})['zip_code'] == '02134'
+    assert _normalize_store({'zip_code': '021345'})['zip_code'] == ''
+    from_address = _normalize_store({'formatted_address': '123 Main St, Austin, TX 78701-1234, USA'})
+    assert (from_address['zip_code'], from_address['city'], from_address['state']) == ('78701', 'Austin', 'TX')
+
+    # States outside the table are kept as given on the store, but never returned as a code
+    assert _normalize_store({'state': 'Ontario'})['state'] == 'Ontario'
+    assert _normalize_state('Ontario') == ''
+    assert _normalize_state('tx') == 'TX'
+    assert _normalize_state('Washington D.C.') == 'DC'
+
+    assert [_normalize_store({'business_status': status})['business_status']
+            for status in ('', 'open', 'CLOSED_PERMANENTLY', 'permanently_closed', 'gone')] == [
+        'OPERATIONAL', 'OPERATIONAL', 'CLOSED_PERMANENTLY', 'CLOSED_PERMANENTLY', 'UNKNOWN']
+
+
+def test_migrate_v2_normalizes_stores_and_folds_legacy_records():
+    """Legacy flat store records become one-store retailer entries without retailer bookkeeping keys."""
+    migrated = _migrate_v2_normalize_stores([
+        {'name': 'Old Shop', 'formatted_address': '1 Beacon St, Boston, MA 02134', 'date_added': '2020-01-01',
+         'total_stores': 5, 'removed': True},
+        {'retailer_name': 'Tecovas', 'stores': [
+            {'name': 'Tecovas', 'zip_code': '2134', 'city': 'Boston', 'state': 'massachusetts'},
+            {'name': 'Tecovas', 'zip_code': '78701', 'city': 'Austin', 'state': 'TX'},
+        ]},
+    ])
+    legacy, current = migrated
+    assert legacy['retailer_name'] == 'Old Shop' and legacy['source'] == 'legacy'
+    assert (legacy['total_stores'], legacy['total_cities'], legacy['removed']) == (1, 1, True)
+    assert legacy['date_added'] == '2020-01-01'
+    assert 'total_stores' not in legacy['stores'][0] and 'removed' not in legacy['stores'][0]
+    assert (legacy['stores'][0]['zip_code'], legacy['stores'][0]['state']) == ('02134', 'MA')
+
+    assert [store['zip_code'] for store in current['stores']] == ['02134', '78701']
+    assert current['stores'][0]['state'] == 'MA'
+    assert (current['total_stores'], current['total_cities']) == (2, 2)
+
+
+def test_city_zip_index_resolves_aliases_and_ranks_shared_names():
+    """Abbreviated and alias names resolve offline, and a city without a state takes its major city's state."""
+    with offline_city_indexes():
+        saint_petersburg = _resolve_city_zips('St. Petersburg', 'fl')
+        assert saint_petersburg and all(zip_code.startswith('337') for zip_code in saint_petersburg)
+        assert '10001' in _resolve_city_zips('New York City', 'NY')
+        assert _resolve_city_zips('Essex County', 'MA')
+        assert _resolve_city_zips('Nowhereville', 'FL') == []
+
+        table = _get_city_state_table()
+        assert _rank_city_states(table, 'Springfield')[:3] == ['MO', 'IL', 'MA']
+        assert _rank_city_states(table, 'Portland')[:2] == ['OR', 'ME']
+        assert _rank_city_states(table, 'Kansas City') == ['MO', 'KS']
+        assert _rank_city_states(table, 'Fayetteville')[0] == 'NC'
+        assert _rank_city_states(table, 'Nowhereville') == []
+
+
+def test_fuzzy_city_match_resolves_misspelled_market_cities():
+    """Misspelled market cities resolve to the closest indexed place instead of being dropped from the upload."""
+    with offline_city_indexes() as data_dir:
+        index = _get_city_trigram_index()
+        assert [match[1:] for match in _fuzzy_match_city(index, 'Sant Petersburg')] == [('saint petersburg', 'FL')]
+        assert [match[1:] for match in _fuzzy_match_city(index, 'Pittsburg', 'PA')] == [('pittsburgh', 'PA')]
+        assert _fuzzy_match_city(index, 'Qwxz Vbnm') == []
+
+        saved = {name: getattr(app, name) for name in ('MARKETS_DB_FILE', 'MARKETS_ARCHIVE_FILE', 'SESSION_DB_FILE')}
+        try:
+            for name in saved:
+                setattr(app, name, os.path.join(data_dir, os.path.basename(saved[name])))
+            upload = BytesIO(b'City\nSant Petersburg\n"Pittsburg, PA"\n')
+            with app.app.test_client() as client:
+                response = client.post('/markets', data={'csv_file': (upload, 'markets.csv')},
+                                       content_type='multipart/form-data')
+            assert response.status_code == 200
+            rows = {(row['City'], row['State']): row['Zip Codes'].split(', ') for row in app._load_markets_db()[-1]['data']}
+        finally:
+            for name, value in saved.items():
+                setattr(app, name, value)
+        assert set(rows) == {('Sant Petersburg', 'FL'), ('Pittsburg', 'PA')}
+        assert rows[('Sant Petersburg', 'FL')] == sorted(_resolve_city_zips('Saint Petersburg', 'FL'))
+        assert rows[('Pittsburg', 'PA')] == sorted(_resolve_city_zips('Pittsburgh', 'PA'))
+        assert all(zip_code.startswith('152') for zip_code in rows[('Pittsburg', 'PA')])
+
+
+def test_city_typeahead_prefix_results():
+    """Prefix suggestions are ranked by ZIP count, accept "st" for "saint", filter by state and respect the limit."""
+    index = _get_city_prefix_index()
+    assert _suggest_cities(index, 'san fr', limit=3) == [('San Francisco', 'CA', 66)]
+    assert _suggest_cities(index, 'St. Pete', limit=1)[0][:2] == ('Saint Petersburg', 'FL')
+    suggestions = _suggest_cities(index, 'sp', limit=5)
+    assert len(suggestions) == 5 and all(name.lower().startswith('sp') for name, _, _ in suggestions)
+    assert [count for _, _, count in suggestions] == sorted((count for _, _, count in suggestions), reverse=True)
+    assert {state for _, state, _ in _suggest_cities(index, 'spring', 'il', limit=10)} == {'IL'}
+
+    with app.app.test_client() as client:
+        cities = client.get('/api/cities?q=springfield, il&limit=2').get_json()['cities']
+        assert cities == [{'city': 'Springfield', 'state': 'IL', 'label': 'Springfield, IL', 'zip_count': 38}]
+        assert len(client.get('/api/cities?q=spr&limit=3').get_json()['cities']) == 3
+        assert client.get('/api/cities?q=').get_json() == {'cities': []}
+        assert client.get('/api/cities?q=spr&limit=many').status_code == 400
+
+
+if __name__ == '__main__':
+    test_pandas_engine_matches_python_engine()
+    test_engines_handle_empty_data()
+    test_patched_view_matches_rebuilt_view()
+    test_markets_history_deltas_round_trip()
+    test_spatial_analysis_rings_and_nearest()
+    test_colocation_counts_shared_zips_cities_and_nearby_stores()
+    test_zip_bitmap_queries_match_set_logic()
+    test_normalize_store_location_and_status_fields()
+    test_migrate_v2_normalizes_stores_and_folds_legacy_records()
+    test_city_zip_index_resolves_aliases_and_ranks_shared_names()
+    test_fuzzy_city_match_resolves_misspelled_market_cities()
+    test_city_typeahead_prefix_results()
+    print("✓ Analysis engines agree")
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Retailer database write-path tests: repeated saves are deduplicated or merged, and
+compact-db collapses duplicate entries. Also covers the SQLite session store. Each
+test works on a temporary data directory.
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import closing, contextmanager
+
+from flask import Flask, session
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app
+from app import _compact_retailer_data, compact_db_command, SqliteSessionInterface
+
+
+@contextmanager
+def temporary_data_files():
+    """Point the retailer database, its materialized view and the session store at a fresh temporary directory."""
+    data_dir = tempfile.mkdtemp()
+    saved = {name: getattr(app, name) for name in ('DB_FILE', 'RETAILER_VIEW_FILE', 'SESSION_DB_FILE')}
+    try:
+        app.DB_FILE = os.path.join(data_dir, 'retailer_database.json')
+        app.RETAILER_VIEW_FILE = os.path.join(data_dir, 'retailer_by_zip.json')
+        app.SESSION_DB_FILE = os.path.join(data_dir, 'sessions.sqlite3')
+        app.ANALYSIS_CACHE.clear()
+        app.DATA_INDEX_CACHE.pop('retailer_view', None)
+        yield data_dir
+    finally:
+        for name, value in saved.items():
+            setattr(app, name, value)
+        app.ANALYSIS_CACHE.clear()
+        app.DATA_INDEX_CACHE.pop('retailer_view', None)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def make_store(place_id, zip_code, city='Austin', state='TX'):
+    return {'name': 'Tecovas', 'place_id': place_id, 'zip_code': zip_code, 'city': city, 'state': state,
+            'formatted_address': f'1 Main St, {city}, {state} {zip_code}, USA'}
+
+
+def save(client, stores, retailer_name='Tecovas'):
+    response = client.post('/save-to-database', json={'retailer_name': retailer_name, 'stores': stores})
+    return response.get_json()
+
+
+def test_repeated_saves_are_skipped_or_merged():
+    """An identical save writes nothing; an overlapping save adds only the new stores to the existing entry."""
+    with temporary_data_files(), app.app.test_client() as client:
+        first = [make_store('p1', '78701'), make_store('p2', '78702')]
+        assert save(client, first)['success']
+        db_version = app._file_version(app.DB_FILE)
+
+        duplicate = save(client, list(reversed(first)))
+        assert duplicate['duplicate'] and duplicate['active_stores'] == 2
+        assert app._file_version(app.DB_FILE) == db_version
+
+        merged = save(client, [make_store('p2', '78702'), make_store('p3', '73301')])
+        assert merged['merged'] and merged['active_stores'] == 3
+        records = app._load_db()
+        assert len(records) == 1
+        assert [store['place_id'] for store in records[0]['stores']] == ['p1', 'p2', 'p3']
+        assert records[0]['content_hash'] == app._stores_content_hash('Tecovas', records[0]['stores'])
+        assert app._load_retailer_view()['zips'] == {'73301': {'Tecovas': 1}, '78701': {'Tecovas': 1},
+                                                     '78702': {'Tecovas': 1}}
+
+        # A subset of the saved stores is not a duplicate payload, but adds nothing either
+        db_version = app._file_version(app.DB_FILE)
+        app.ANALYSIS_CACHE['marker'] = []
+        unchanged = save(client, [make_store('p1', '78701')])
+        assert unchanged['merged'] and unchanged['active_stores'] == 3
+        assert app._file_version(app.DB_FILE) == db_version
+        assert 'marker' in app.ANALYSIS_CACHE
+
+
+def test_compact_retailer_data_merges_duplicate_entries():
+    """Entries with the same name and removed flag collapse into the oldest one, each store kept once."""
+    retailer_data = [
+        {'retailer_name': 'Tecovas', 'stores': [make_store('p1', '78701'), make_store('p2', '78702')]},
+        {'retailer_name': 'tecovas ', 'stores': [make_store('p2', '78702'), make_store('p3', '73301', 'Dallas')]},
+        {'retailer_name': 'Tecovas', 'removed': True, 'stores': [make_store('p4', '10001', 'New York', 'NY')]},
+        {'retailer_name': 'PacSun', 'stores': []},
+    ]
+    compacted, merged = _compact_retailer_data(retailer_data)
+    assert merged == 1
+    assert [(entry['retailer_name'], bool(entry.get('removed'))) for entry in compacted] == [
+        ('Tecovas', False), ('Tecovas', True), ('PacSun', False)]
+    tecovas = compacted[0]
+    assert [store['place_id'] for store in tecovas['stores']] == ['p1', 'p2', 'p3']
+    assert (tecovas['total_stores'], tecovas['total_cities']) == (3, 2)
+    assert tecovas['content_hash'] == app._stores_content_hash('Tecovas', tecovas['stores'])
+
+
+def test_compact_db_command_reports_counts():
+    """flask compact-db rewrites the database only when something was merged and reports the counts."""
+    with temporary_data_files():
+        app._save_db([
+            {'retailer_name': 'Tecovas', 'stores': [make_store('p1', '78701')]},
+            {'retailer_name': 'Tecovas', 'stores': [make_store('p2', '78702')]},
+            {'retailer_name': 'PacSun', 'stores': [make_store('p3', '73301')]},
+        ])
+        runner = app.app.test_cli_runner()
+        result = runner.invoke(compact_db_command)
+        assert result.output.strip() == 'Merged 1 duplicate retailer entries; 2 remain'
+        assert [entry['total_stores'] for entry in app._load_db()] == [2, 1]
+
+        db_version = app._file_version(app.DB_FILE)
+        result = runner.invoke(compact_db_command)
+        assert result.output.strip() == 'Merged 0 duplicate retailer entries; 2 remain'
+        assert app._file_version(app.DB_FILE) == db_version
+
+
+def make_session_app():
+    """Minimal app on SqliteSessionInterface: /set/<value> stores a value, /get reads it back."""
+    session_app = Flask(__name__)
+    session_app.secret_key = 'test'
+    session_app.session_interface = SqliteSessionInterface()
+
+    @session_app.route('/set/<value>')
+    def set_value(value):
+        session['value'] = value
+        return ''
+
+    @session_app.route('/get')
+    def get_value():
+        return session.get('value', '')
+
+    return session_app
+
+
+def stored_sessions():
+    with closing(sqlite3.connect(app.SESSION_DB_FILE)) as conn:
+        return dict(conn.execute('SELECT sid, expires FROM sessions').fetchall())
+
+
+def test_sqlite_sessions_round_trip_and_expire():
+    """Session data is stored server-side under the cookie's sid; an expired sid starts a new, empty session."""
+    with temporary_data_files():
+        session_app = make_session_app()
+        client = session_app.test_client()
+        client.get('/set/' + 'x' * 5000)
+        sid = client.get_cookie('session').value
+        assert list(stored_sessions()) == [sid]
+        assert client.get('/get').get_data(as_text=True) == 'x' * 5000
+
+        with closing(sqlite3.connect(app.SESSION_DB_FILE)) as conn, conn:
+            conn.execute('UPDATE sessions SET expires = ?', (time.time() - 1,))
+        assert client.get('/get').get_data(as_text=True) == ''
+        client.get('/set/fresh')
+        assert client.get_cookie('session').value != sid
+
+
+def test_sqlite_session_cookie_carries_only_the_sid():
+    """The cookie value is the opaque session id, never the session data."""
+    with temporary_data_files():
+        client = make_session_app().test_client()
+        response = client.get('/set/secret-value')
+        cookie = response.headers['Set-Cookie']
+        sid = client.get_cookie('session').value
+        assert cookie.startswith(f'session={sid};') and 'secret-value' not in cookie
+        assert len(sid) == 43
+
+
+def test_session_saves_purge_expired_rows_periodically():
+    """Every SESSION_PURGE_EVERY_SAVES saves also delete expired rows, without waiting for a restart."""
+    purge_every = app.SESSION_PURGE_EVERY_SAVES
+    try:
+        app.SESSION_PURGE_EVERY_SAVES = 3
+        with temporary_data_files():
+            session_app = make_session_app()
+            client = session_app.test_client()
+            client.get('/set/a')
+            with closing(sqlite3.connect(app.SESSION_DB_FILE)) as conn, conn:
+                conn.execute("INSERT INTO sessions (sid, data, expires) VALUES ('stale', '{}', ?)", (time.time() - 1,))
+            client.get('/set/b')
+            assert 'stale' in stored_sessions()
+            client.get('/set/c')
+            assert list(stored_sessions()) == [client.get_cookie('session').value]
+    finally:
+        app.SESSION_PURGE_EVERY_SAVES = purge_every
+
+
+def test_remove_retailer_accepts_string_index():
+    """A retailer_index sent as a string is coerced; one that is not a number is rejected, not a server error."""
+    with temporary_data_files() as data_dir, app.app.test_client() as client:
+        archive_file = app.RETAILER_ARCHIVE_FILE
+        try:
+            app.RETAILER_ARCHIVE_FILE = os.path.join(data_dir, 'retailer_archive.json')
+            save(client, [make_store('p1', '78701')])
+            rejected = client.post('/remove-retailer', json={'retailer_index': 'first'}).get_json()
+            assert rejected == {'success': False, 'error': 'Invalid retailer index'}
+            removed = client.post('/remove-retailer', json={'retailer_index': '0'}).get_json()
+            assert removed['success'] and removed['remaining_retailers'] == 0
+            assert [entry['retailer_name'] for entry in app._load_retailer_archive()] == ['Tecovas']
+        finally:
+            app.RETAILER_ARCHIVE_FILE = archive_file
+
+
+if __name__ == '__main__':
+    test_repeated_saves_are_skipped_or_merged()
+    test_compact_retailer_data_merges_duplicate_entries()
+    test_compact_db_command_reports_counts()
+    test_remove_retailer_accepts_string_index()
+    test_sqlite_sessions_round_trip_and_expire()
+    test_sqlite_session_cookie_carries_only_the_sid()
+    test_session_saves_purge_expired_rows_periodically()
+    print("✓ Retailer database writes are deduplicated and sessions are stored server-side")